@@ -0,0 +1,80 @@
+"""Measure the objects allocated for each request by bihan.
+
+The application is called directly with a WSGI environment, without a
+server. The requests are processed (the function is run and the response
+is prepared) but the per-request objects are kept alive, so that the
+number of memory blocks and the bytes they use can be counted per request.
+
+Usage : python bench_objects.py [number of requests]
+"""
+
+import gc
+import io
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "src"))
+
+from bihan import application
+
+nb = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+
+def hello(dialog):
+    return "hello"
+
+def greet(dialog):
+    return "hello " + dialog.request.fields.get("name", "")
+
+def environ(url, query=""):
+    return {
+        "REQUEST_METHOD": "GET",
+        "PATH_INFO": url,
+        "QUERY_STRING": query,
+        "SERVER_PROTOCOL": "HTTP/1.1",
+        "SERVER_NAME": "localhost",
+        "SERVER_PORT": "8000",
+        "REMOTE_ADDR": "127.0.0.1",
+        "HTTP_HOST": "localhost:8000",
+        "HTTP_USER_AGENT": "bench",
+        "HTTP_ACCEPT": "*/*",
+        "wsgi.input": io.BytesIO(),
+    }
+
+def start_response(status, headers):
+    pass
+
+def serve(url, query):
+    result = application(environ(url, query), start_response)
+    result.prepare()
+    return result
+
+def measure(url, query=""):
+    environs = [environ(url, query) for i in range(nb)]
+    gc.collect()
+    gc.disable()
+    tracemalloc.start()
+    blocks = sys.getallocatedblocks()
+    before = tracemalloc.get_traced_memory()[0]
+    results = [application(env, start_response) for env in environs]
+    for result in results:
+        result.prepare()
+    size = tracemalloc.get_traced_memory()[0] - before
+    blocks = sys.getallocatedblocks() - blocks
+    tracemalloc.stop()
+    del results
+    gc.enable()
+    t0 = time.perf_counter()
+    for i in range(nb):
+        serve(url, query).close()
+    elapsed = (time.perf_counter() - t0) / nb
+    print("{:<24} blocks per request : {:>5}  bytes per request : {:>6}  "
+        "time : {:.1f} µs".format(url + ("?" + query if query else ""),
+        blocks // nb, size // nb, elapsed * 1e6))
+
+if __name__ == "__main__":
+    application.load_routes()
+    measure("/hello")
+    measure("/greet", "name=bihan")
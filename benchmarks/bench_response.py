@@ -0,0 +1,73 @@
+"""Measure the memory allocated to serve a request with bihan.
+
+The application is called directly with a WSGI environment, without a
+server, and tracemalloc counts the bytes allocated while the request is
+processed and the response body is iterated.
+
+Usage : python bench_response.py [body size in bytes]
+"""
+
+import io
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "src"))
+
+from bihan import application
+
+size = int(sys.argv[1]) if len(sys.argv) > 1 else 1 << 20
+text = "x" * size
+
+def page(dialog):
+    return text
+
+def redirect(dialog):
+    return dialog.redirection("/page")
+
+def environ(url):
+    return {
+        "REQUEST_METHOD": "GET",
+        "PATH_INFO": url,
+        "QUERY_STRING": "",
+        "SERVER_PROTOCOL": "HTTP/1.1",
+        "SERVER_NAME": "localhost",
+        "SERVER_PORT": "8000",
+        "REMOTE_ADDR": "127.0.0.1",
+        "wsgi.input": io.BytesIO(),
+    }
+
+def start_response(status, headers):
+    pass
+
+def serve(url):
+    result = application(environ(url), start_response)
+    for chunk in result:
+        pass
+    result.close()
+
+def measure(url, nb=20):
+    serve(url) # warm up
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    allocated = 0
+    for i in range(nb):
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        serve(url)
+        allocated += tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+    t0 = time.perf_counter()
+    for i in range(nb):
+        serve(url)
+    elapsed = (time.perf_counter() - t0) / nb
+    print("{:<12} peak bytes allocated per request : {:>10}  time : {:.1f} µs"
+        .format(url, allocated // nb, elapsed * 1e6))
+
+if __name__ == "__main__":
+    application.load_routes()
+    print("response body : {} bytes".format(size))
+    measure("/page")
+    measure("/redirect")
@@ -13,13 +13,25 @@ import urllib.parse
 import http.cookies
 import http.server
 import email.utils
-import email.message
 import json
 import threading
 import subprocess
 import signal
 import types
-import wsgiref.simple_server
+import uuid
+import asyncio
+import inspect
+import functools
+import mimetypes
+import mmap
+import collections
+import queue
+import time
+import hashlib
+import zlib
+
+from . import server as _server
+from .multipart import MultipartParser, MultipartError
 
 http_methods = ["GET", "POST", "DELETE", "PUT", "OPTIONS", "HEAD", "TRACE",
     "CONNECT"]
@@ -34,30 +46,1571 @@ class HttpError:
     def __init__(self, code):
         self.code = code
 
+class EventStream:
+    """Return value of a function that sends Server-Sent Events. events is
+    an iterator, or an asynchronous iterator, of events : strings, or
+    dictionaries with the keys "data", "event", "id" and "retry". A comment
+    is sent every heartbeat seconds without events, to keep the connection
+    open and detect closed connections."""
+
+    def __init__(self, events, heartbeat=15):
+        self.events = events
+        self.heartbeat = heartbeat
+
+    def close(self):
+        if hasattr(self.events, "close"):
+            self.events.close()
+
 class DispatchError(Exception): pass
+class RequestBodyError(ValueError): pass
 class RoutingError(Exception): pass
 
+
+def _segment_regexp(segment):
+    """Regular expression for a url segment that includes smart parts
+    such as <x>."""
+    parts = re.split("<(.*?)>", segment)
+    for i, part in enumerate(parts):
+        if i % 2:
+            parts[i] = "(?P<{}>[^/]+?)".format(part)
+        else:
+            parts[i] = re.escape(part)
+    return re.compile("^" + "".join(parts) + "$", flags=re.I)
+
+def _segments_overlap(seg1, seg2):
+    """Return True if some string can match both url segments."""
+    smart1, smart2 = "<" in seg1, "<" in seg2
+    if not smart1 and not smart2:
+        return seg1.lower() == seg2.lower()
+    elif not smart2:
+        return _segment_regexp(seg1).match(seg2) is not None
+    elif not smart1:
+        return _segment_regexp(seg2).match(seg1) is not None
+    # Both segments are smart : compare the literal text before the first
+    # smart part and after the last one
+    parts1, parts2 = re.split("<.*?>", seg1), re.split("<.*?>", seg2)
+    start1, start2 = parts1[0].lower(), parts2[0].lower()
+    end1, end2 = parts1[-1].lower(), parts2[-1].lower()
+    return ((start1.startswith(start2) or start2.startswith(start1))
+        and (end1.endswith(end2) or end2.endswith(end1)))
+
+
+class _RouteNode:
+    """Node in the trie of url segments used for smart urls."""
+
+    __slots__ = ("literals", "smart", "target")
+
+    def __init__(self):
+        self.literals = {} # lower case segment => _RouteNode
+        self.smart = [] # list of (segment, regexp, _RouteNode)
+        self.target = None
+
+
+class RouteIndex:
+    """Compiled dispatch structure for the routes of one HTTP method : a
+    dictionary for literal urls and a trie of url segments for smart urls.
+    """
+
+    def __init__(self):
+        self.exact = {}
+        self.tree = _RouteNode()
+        self.urls = {} # url => function, used to detect ambiguous routes
+
+    def add(self, url, obj):
+        """Map url (starting with "/") to the function obj."""
+        self.urls[url] = obj
+        if "<" not in url:
+            self.exact[url.lower()] = obj
+            return
+        node = self.tree
+        for segment in url[1:].split("/"):
+            if "<" not in segment:
+                node = node.literals.setdefault(segment.lower(), _RouteNode())
+                continue
+            for smart_segment, regexp, child in node.smart:
+                if smart_segment == segment:
+                    node = child
+                    break
+            else:
+                child = _RouteNode()
+                node.smart.append((segment, _segment_regexp(segment), child))
+                node = child
+        node.target = obj
+
+    def find(self, url):
+        """Return the function mapped to url."""
+        return self.urls[url]
+
+    def match(self, url):
+        """If url matches one of the routes, return the tuple
+        (function_object, arguments) where arguments is a dictionary for
+        smart urls. Otherwise return None.
+        """
+        obj = self.exact.get(url.lower())
+        if obj is not None:
+            return obj, {}
+        if not url.startswith("/"):
+            return None
+        return self._match(self.tree, url[1:].split("/"), 0)
+
+    def _match(self, node, segments, pos):
+        if pos == len(segments):
+            if node.target is None:
+                return None
+            return node.target, {}
+        segment = segments[pos]
+        child = node.literals.get(segment.lower())
+        if child is not None:
+            found = self._match(child, segments, pos + 1)
+            if found is not None:
+                return found
+        for _, regexp, child in node.smart:
+            mo = regexp.match(segment)
+            if mo:
+                found = self._match(child, segments, pos + 1)
+                if found is not None:
+                    found[1].update(mo.groupdict())
+                    return found
+        return None
+
+    def overlaps(self, url):
+        """Return a url already mapped in the index such that some urls
+        would match both patterns, or None."""
+        segments = url[1:].split("/")
+        for other in self.urls:
+            other_segments = other[1:].split("/")
+            if len(other_segments) == len(segments) and all(
+                    _segments_overlap(seg1, seg2)
+                    for seg1, seg2 in zip(segments, other_segments)):
+                return other
+        return None
+
+class Headers:
+    """Case-insensitive multidict of HTTP headers, with the interface of
+    email.message.Message used for HTTP : setting a header adds it (a
+    header can have several values), getting a missing header returns None,
+    deleting a header removes all its values.
+
+    Headers are indexed by their lowercase name, so that lookups don't scan
+    the whole list.
+    """
+
+    __slots__ = ["_headers"]
+
+    def __init__(self, items=()):
+        # lowercase name => list of (name, value) pairs
+        self._headers = {}
+        for name, value in items:
+            self[name] = value
+
+    def __contains__(self, name):
+        return name.lower() in self._headers
+
+    def __delitem__(self, name):
+        self._headers.pop(name.lower(), None)
+
+    def __getitem__(self, name):
+        return self.get(name)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return sum(len(pairs) for pairs in self._headers.values())
+
+    def __setitem__(self, name, value):
+        pairs = self._headers.get(name.lower())
+        if pairs is None:
+            self._headers[name.lower()] = [(name, value)]
+        else:
+            pairs.append((name, value))
+
+    def get(self, name, failobj=None):
+        pairs = self._headers.get(name.lower())
+        return pairs[0][1] if pairs else failobj
+
+    def get_all(self, name, failobj=None):
+        pairs = self._headers.get(name.lower())
+        return [value for (_, value) in pairs] if pairs else failobj
+
+    def items(self):
+        return [pair for pairs in self._headers.values() for pair in pairs]
+
+    def keys(self):
+        return [name for pairs in self._headers.values()
+            for (name, _) in pairs]
+
+    def values(self):
+        return [value for pairs in self._headers.values()
+            for (_, value) in pairs]
+
+    def replace_header(self, name, value):
+        """Replace the first value of header name. Raise KeyError if it is
+        missing."""
+        pairs = self._headers.get(name.lower())
+        if not pairs:
+            raise KeyError(name)
+        pairs[0] = (pairs[0][0], value)
+
+    def set_param(self, param, value):
+        """Set a parameter in the Content-Type header."""
+        ctype = self.get("Content-Type") or "text/plain"
+        params = [p for p in ctype.split(";")[1:]
+            if p.strip().split("=", 1)[0].lower() != param.lower()]
+        params.append(' {}="{}"'.format(param, value))
+        self._set_content_type(ctype.split(";", 1)[0] + ";".join([""] +
+            params))
+
+    def set_type(self, ctype):
+        """Set the type of the Content-Type header, keeping its parameters.
+        """
+        current = self.get("Content-Type")
+        if current is not None and ";" in current:
+            ctype += ";" + current.split(";", 1)[1]
+        self._set_content_type(ctype)
+
+    def _set_content_type(self, value):
+        pairs = self._headers.get("content-type")
+        if pairs:
+            pairs[:] = [(pairs[0][0], value)]
+        else:
+            self._headers["content-type"] = [("Content-Type", value)]
+
+
 class Message:
-    """Generic class for request and response objects"""
+    """Response object. The cookies are created when they are used.
+
+    etag and last_modified are the validators of the response, sent in the
+    headers ETag and Last-Modified : etag is a string, or True to compute it
+    from the response body ; last_modified is a datetime or a timestamp.
+    """
+
+    # __dict__ : the script functions can set their own attributes, the
+    # dictionary is only created if they do
+    __slots__ = ["headers", "encoding", "body", "status", "etag",
+        "last_modified", "_cookies", "__dict__"]
 
     def __init__(self):
-        self.headers = email.message.Message()
-        self.cookies = http.cookies.SimpleCookie()
+        self.headers = Headers()
+        self.encoding = "utf-8"
+        self.body = b""
+        self.etag = None
+        self.last_modified = None
+        self._cookies = None
+
+    @property
+    def cookies(self):
+        if self._cookies is None:
+            self._cookies = http.cookies.SimpleCookie()
+        return self._cookies
+
+
+class RequestStream:
+    """File-like object to read the request body incrementally from fp :
+    at most length bytes, or a body sent with chunked transfer encoding if
+    length is None. Iterating on the object yields the lines of the body.
+    """
+
+    block_size = 1 << 16
+
+    def __init__(self, fp, length=None):
+        self.fp = fp
+        self.remaining = length
+        self.chunk_remaining = 0
+        self.buffer = bytearray()
+        self.eof = False
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                break
+            yield line
+
+    def read(self, size=-1):
+        """Read at most size bytes, or the rest of the body."""
+        buffer = self.buffer
+        if size is None or size < 0:
+            while self._fill():
+                pass
+            size = len(buffer)
+        else:
+            while len(buffer) < size and self._fill():
+                pass
+        data = bytes(buffer[:size])
+        del buffer[:size]
+        return data
+
+    def readline(self, size=-1):
+        """Read a line, or at most size bytes."""
+        buffer = self.buffer
+        start = 0
+        while True:
+            pos = buffer.find(b"\n", start)
+            if pos != -1:
+                end = pos + 1
+                break
+            start = len(buffer)
+            if 0 <= size <= start or not self._fill():
+                end = start
+                break
+        if 0 <= size < end:
+            end = size
+        line = bytes(buffer[:end])
+        del buffer[:end]
+        return line
+
+    def _fill(self):
+        """Add the next block of the body to the buffer ; return False at the
+        end of the body."""
+        if self.eof:
+            return False
+        if self.remaining is None:
+            data = self._read_chunk()
+        else:
+            size = min(self.block_size, self.remaining)
+            data = self.fp.read(size) if size else b""
+            self.remaining -= len(data)
+        if not data:
+            self.eof = True
+            return False
+        self.buffer += data
+        return True
+
+    def _read_chunk(self):
+        """Read data in chunked transfer encoding."""
+        if not self.chunk_remaining:
+            line = self.fp.readline(1024)
+            try:
+                self.chunk_remaining = int(line.split(b";", 1)[0], 16)
+            except ValueError:
+                raise RequestBodyError("invalid chunk size")
+            if not self.chunk_remaining:
+                # last chunk : skip the trailer
+                while line not in (b"\r\n", b"\n", b""):
+                    line = self.fp.readline(65537)
+                return b""
+        data = self.fp.read(min(self.block_size, self.chunk_remaining))
+        if not data:
+            raise RequestBodyError("incomplete chunk")
+        self.chunk_remaining -= len(data)
+        if not self.chunk_remaining:
+            # end of chunk
+            self.fp.readline(1024)
+        return data
+
+
+class Request:
+    """Information sent by the user agent. The headers, cookies, fields and
+    body are parsed from the WSGI environment the first time they are used.
+    """
+
+    __slots__ = ["environ", "url", "method", "url_fields", "stream_parts",
+        "_headers", "_cookies", "_encoding", "_fields", "_raw", "_json",
+        "_stream", "__dict__"]
+
+    def __init__(self, environ):
+        self.environ = environ
+        self.url = environ["PATH_INFO"]
+        self.method = environ["REQUEST_METHOD"]
+        # named arguments of smart urls, added to the fields
+        self.url_fields = {}
+        # set if the function has the attribute stream_parts : the parts of
+        # a multipart body are not in the fields, they are read by iterating
+        # on self.parts
+        self.stream_parts = False
+        self._headers = None
+        self._cookies = None
+        self._encoding = None
+        self._fields = None
+        self._raw = None
+        self._json = None
+        self._stream = None
+
+    @property
+    def cookies(self):
+        if self._cookies is None:
+            self._cookies = http.cookies.SimpleCookie(
+                self.environ.get("HTTP_COOKIE", ""))
+        return self._cookies
+
+    @property
+    def encoding(self):
+        """Encoding of the request data : the charset defined in one of the
+        headers, or "iso-8859-1"."""
+        if self._encoding is None:
+            self._encoding = "iso-8859-1"
+            for key in self.headers:
+                mo = re.search(r"charset\s*=(.*)$", self.headers[key])
+                if mo:
+                    self._encoding = mo.groups()[0]
+                    break
+        return self._encoding
+
+    @property
+    def fields(self):
+        """Dictionary indexed by field names. If field name ends with [], the
+        value is a list of values. Else, it is a single value, or a list if
+        there are several values."""
+        if self._fields is None:
+            self._fields = self._parse_fields()
+        return self._fields
+
+    @property
+    def headers(self):
+        if self._headers is None:
+            headers = Headers()
+            for key, value in self.environ.items():
+                if key == "HTTP_COOKIE":
+                    continue
+                elif key.startswith("HTTP_"):
+                    headers[key[5:].replace('_', '-')] = value
+                elif key.upper() == "CONTENT_LENGTH":
+                    headers["Content-Length"] = value
+                elif key.upper() == "CONTENT_TYPE":
+                    headers["Content-Type"] = value
+            self._headers = headers
+        return self._headers
+
+    @property
+    def parts(self):
+        """Iterator on the parts of a multipart body, for functions with the
+        attribute stream_parts. The content of each part is read from the
+        request body while it is iterated."""
+        if not self.stream_parts:
+            raise AttributeError("parts can only be used by functions with "
+                "the attribute stream_parts")
+        ctype, params = cgi.parse_header(
+            self.environ.get("CONTENT_TYPE") or "")
+        if not ctype.startswith("multipart/"):
+            raise MultipartError("request body is not multipart")
+        return iter(MultipartParser(self.stream, params.get("boundary")))
+
+    @property
+    def raw(self):
+        """Request body as bytes, if it is not structured with keys and
+        values (eg JSON content)."""
+        if self._raw is None:
+            # empty if the body was read to set the fields
+            self._raw = self.stream.read()
+        return self._raw
+
+    @property
+    def stream(self):
+        """RequestStream to read the request body incrementally."""
+        if self._stream is None:
+            chunked = "chunked" in self.environ.get("HTTP_TRANSFER_ENCODING",
+                "").lower()
+            length = None if chunked else int(
+                self.environ.get("CONTENT_LENGTH") or 0)
+            self._stream = RequestStream(self.environ["wsgi.input"], length)
+        return self._stream
+
+    def has_keys(self):
+        """Return True if the request body is structured with key and value.
+        """
+        if self.method not in ["POST", "PUT", "DELETE", "PATCH"]:
+            return False
+        ctype = self.environ.get("CONTENT_TYPE")
+        return (not ctype or ctype == "application/x-www-form-urlencoded"
+            or ctype.startswith("multipart/"))
+
+    def json(self):
+        """Return the result of the JSON parsing of the request body."""
+        if self._json is None:
+            self._json = json.loads(self.raw.decode(self.encoding))
+        return self._json
+
+    def ndjson(self):
+        """Iterate on the values of a body with a JSON value on each line
+        (NDJSON), read incrementally."""
+        for line in self.stream:
+            line = line.strip()
+            if line:
+                yield json.loads(line.decode(self.encoding))
+
+    def _parse_fields(self):
+        # Get request fields from query string
+        qs = self.environ.get("QUERY_STRING")
+        fields = {}
+        if qs:
+            fields = _group_fields(urllib.parse.parse_qsl(qs,
+                keep_blank_values=True))
+
+        # If data is not structured with key and value (eg JSON content),
+        # it is only read by the attribute "raw" and the method "json"
+        if self.has_keys():
+            fp = self.stream
+            if self._raw is not None:
+                fp = io.BytesIO(self._raw)
+            ctype, params = cgi.parse_header(
+                self.environ.get("CONTENT_TYPE") or "")
+
+            # Update request fields from POST data. If the function has the
+            # attribute stream_parts, the parts of a multipart body are read
+            # by iterating on self.parts
+            if not ctype.startswith("multipart/"):
+                data = fp.read()
+                fields.update(_group_fields(urllib.parse.parse_qsl(
+                    data.decode("utf-8", "replace"), keep_blank_values=True)))
+            elif not self.stream_parts:
+                parser = MultipartParser(fp, params.get("boundary"))
+                # file uploads : the value is the Part object
+                fields.update(_group_fields((part.name,
+                    part if part.filename else part.value)
+                    for part in parser.parts()))
+
+        fields.update(self.url_fields)
+        return fields
+
+
+def _group_fields(pairs):
+    """Return a dictionary for the (name, value) pairs : if name ends with
+    [], the value is a list of values. Else, it is a single value, or a list
+    if there are several values."""
+    fields = {}
+    for name, value in pairs:
+        if name.endswith("[]"):
+            fields.setdefault(name[:-2], []).append(value)
+        elif name in fields:
+            if isinstance(fields[name], list):
+                fields[name].append(value)
+            else:
+                fields[name] = [fields[name], value]
+        else:
+            fields[name] = value
+    return fields
+
+
+class FileBody:
+    """Response body that sends length bytes of a file, starting at offset.
+    The content is read by blocks, or sent by the built-in server without
+    being read in Python (os.sendfile)."""
+
+    block_size = 1 << 16
+
+    def __init__(self, fobj, offset, length):
+        self.file = fobj
+        self.offset = offset
+        self.length = length
+        self.remaining = length
+        fobj.seek(offset)
+
+    def __iter__(self):
+        while True:
+            data = self.read(self.block_size)
+            if not data:
+                break
+            yield data
+
+    def close(self):
+        self.file.close()
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+
+def _file_body(fobj):
+    """If fobj is a binary file of the file system, return a FileBody that
+    sends it from its current position. Otherwise return None."""
+    if isinstance(fobj, io.TextIOBase):
+        return None
+    try:
+        size = os.fstat(fobj.fileno()).st_size
+        offset = fobj.tell()
+    except (AttributeError, OSError, ValueError):
+        return None
+    return FileBody(fobj, offset, max(size - offset, 0))
+
+
+class StreamBody:
+    """Response body built from an iterator or a file object returned by a
+    function. It is sent by chunks ; str chunks are encoded when they are
+    sent."""
+
+    block_size = 1 << 16
+
+    def __init__(self, source, encoding):
+        self.source = source
+        self.encoding = encoding
+
+    def __iter__(self):
+        read = getattr(self.source, "read", None)
+        chunks = self.source if read is None else self._read_blocks(read)
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode(self.encoding)
+            elif not isinstance(chunk, bytes):
+                chunk = str(chunk).encode(self.encoding)
+            if chunk:
+                yield chunk
+
+    def close(self):
+        if hasattr(self.source, "close"):
+            self.source.close()
+
+    def _read_blocks(self, read):
+        while True:
+            data = read(self.block_size)
+            if not data:
+                break
+            yield data
+
+
+class CompressedBody:
+    """Response body sent by chunks, compressed as the chunks are produced.
+    Each chunk is flushed, so that the client receives it without waiting
+    for the end of the body."""
+
+    def __init__(self, body, compressor):
+        self.body = body
+        self.compressor = compressor
+
+    def __iter__(self):
+        compressor = self.compressor
+        for chunk in self.body:
+            data = (compressor.compress(chunk)
+                + compressor.flush(zlib.Z_SYNC_FLUSH))
+            if data:
+                yield data
+        yield compressor.flush()
+
+    def close(self):
+        if hasattr(self.body, "close"):
+            self.body.close()
+
+
+def _format_event(event):
+    """Return the bytes sent for an event in an event stream."""
+    if not isinstance(event, dict):
+        event = {"data": event}
+    lines = []
+    for key in ("event", "id", "retry"):
+        if key in event:
+            lines.append("{}: {}".format(key, event[key]))
+    data = event.get("data", "")
+    if isinstance(data, bytes):
+        data = data.decode("utf-8")
+    elif not isinstance(data, str):
+        data = json.dumps(data)
+    for line in data.split("\n"):
+        lines.append("data: " + line)
+    return ("\n".join(lines) + "\n\n").encode("utf-8")
+
+
+class EventStreamBody:
+    """Response body for an EventStream.
+
+    Events are produced in a separate thread, so that heartbeats can be
+    sent while the iterator waits for the next event. When the response is
+    closed (the client closed the connection), the iterator is closed after
+    its next event.
+    """
+
+    heartbeat_comment = b":\n\n"
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.events = queue.Queue(16)
+        self.closed = False
+        self.started = False
+        # asynchronous iterators are iterated by the ASGI event loop
+        self.asynchronous = hasattr(stream.events, "__aiter__")
+
+    def __iter__(self):
+        self.started = True
+        producer = threading.Thread(target=self._produce, daemon=True)
+        producer.start()
+        # send the headers without waiting for the first event
+        yield self.heartbeat_comment
+        while True:
+            try:
+                event = self.events.get(timeout=self.stream.heartbeat)
+            except queue.Empty:
+                yield self.heartbeat_comment
+                continue
+            if event is None:
+                break
+            yield event
+
+    async def __aiter__(self):
+        self.started = True
+        events = self.stream.events.__aiter__()
+        yield self.heartbeat_comment
+        try:
+            next_event = None
+            while not self.closed:
+                if next_event is None:
+                    next_event = asyncio.ensure_future(events.__anext__())
+                done, pending = await asyncio.wait([next_event],
+                    timeout=self.stream.heartbeat)
+                if not done:
+                    yield self.heartbeat_comment
+                    continue
+                try:
+                    event = next_event.result()
+                except StopAsyncIteration:
+                    break
+                next_event = None
+                yield _format_event(event)
+        finally:
+            if next_event is not None:
+                next_event.cancel()
+            if hasattr(events, "aclose"):
+                await events.aclose()
+
+    def close(self):
+        self.closed = True
+        if not self.started:
+            self.stream.close()
+
+    def _produce(self):
+        """Put the formatted events in the queue, then None."""
+        try:
+            if self.asynchronous:
+                asyncio.run(self._produce_async())
+            else:
+                for event in self.stream.events:
+                    if not self._put(_format_event(event)):
+                        break
+        except Exception:
+            traceback.print_exc()
+        finally:
+            if not self.asynchronous:
+                self.stream.close()
+            self._put(None)
+
+    async def _produce_async(self):
+        events = self.stream.events
+        try:
+            async for event in events:
+                if not self._put(_format_event(event)):
+                    break
+        finally:
+            if hasattr(events, "aclose"):
+                await events.aclose()
+
+    def _put(self, item):
+        """Put item in the queue ; return False if the response is closed.
+        """
+        while not self.closed:
+            try:
+                self.events.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+
+class MultipartRangesBody:
+    """Response body for a request with several byte ranges of a file, sent
+    as multipart/byteranges."""
+
+    def __init__(self, fobj, ranges, ctype, size):
+        self.file = fobj
+        self.boundary = uuid.uuid4().hex
+        self.parts = [] # list of (part headers, offset, length)
+        for first, last in ranges:
+            headers = ("\r\n--{}\r\nContent-Type: {}\r\n"
+                "Content-Range: bytes {}-{}/{}\r\n\r\n").format(
+                self.boundary, ctype, first, last, size)
+            self.parts.append((headers.encode("latin-1"), first,
+                last - first + 1))
+        self.end = "\r\n--{}--\r\n".format(self.boundary).encode("ascii")
+        self.length = len(self.end) + sum(len(headers) + length
+            for (headers, offset, length) in self.parts)
+
+    def __iter__(self):
+        for headers, offset, length in self.parts:
+            yield headers
+            yield from FileBody(self.file, offset, length)
+        yield self.end
+
+    def close(self):
+        self.file.close()
+
+
+class MemoryFile:
+    """File-like object to read the content of a file stored in the static
+    files cache (bytes or mmap). Each instance has its own position, so that
+    the same content can be sent to several clients at the same time."""
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def close(self):
+        pass
+
+    def read(self, size=-1):
+        if size < 0:
+            size = len(self.data) - self.pos
+        data = self.data[self.pos:self.pos + size]
+        self.pos += len(data)
+        return data
+
+    def seek(self, pos):
+        self.pos = pos
+
+
+class StaticFile:
+    """Validators and response headers for a static file. If the file is in
+    the static files cache, data is its content."""
+
+    def __init__(self, path, fs, ctype, last_modified):
+        self.path = path
+        self.ctype = ctype
+        self.mtime = fs.st_mtime
+        self.mtime_ns = fs.st_mtime_ns
+        self.size = fs.st_size
+        self.last_modified = last_modified
+        self.etag = '"{:x}-{:x}"'.format(fs.st_mtime_ns, fs.st_size)
+        self.headers = [
+            ("Content-Type", ctype),
+            ("Content-Length", str(fs.st_size)),
+            ("Last-Modified", last_modified),
+            ("ETag", self.etag),
+            ("Accept-Ranges", "bytes")
+        ]
+        self.data = None
+
+
+class StaticCache:
+    """In-memory cache of static files, used if application.static_cache is
+    set to an instance of this class.
+
+    Files of at most max_file_size bytes are kept in memory, with their
+    response headers, until the total size of the cached files exceeds
+    max_size : the least recently used files are then removed from the cache.
+    If mmap_size is set, files of at least this size are mapped in memory
+    instead of being read.
+
+    A cached file is revalidated by its modification time and size at each
+    request.
+    """
+
+    def __init__(self, max_size=1 << 24, max_file_size=1 << 20,
+            mmap_size=None):
+        self.max_size = max_size
+        self.max_file_size = max_file_size
+        self.mmap_size = mmap_size
+        self.files = collections.OrderedDict() # path => StaticFile
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def add(self, static, fobj):
+        """Store the content of static, read from the file object fobj, if
+        its size is small enough. Return True if the file was cached."""
+        if static.size > self.max_file_size or static.size > self.max_size:
+            return False
+        if self.mmap_size is not None and 0 < self.mmap_size <= static.size:
+            data = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            data = fobj.read()
+        if len(data) != static.size:
+            # the file was modified since os.fstat()
+            return False
+        static.data = data
+        with self.lock:
+            self._remove(static.path)
+            self.files[static.path] = static
+            self.size += static.size
+            while self.size > self.max_size:
+                self._remove(next(iter(self.files)))
+        return True
+
+    def clear(self):
+        """Remove all the files from the cache."""
+        with self.lock:
+            self.files.clear()
+            self.size = 0
+
+    def get(self, path):
+        """Return the cached StaticFile for path if it is still valid, or
+        None."""
+        with self.lock:
+            static = self.files.get(path)
+        if static is not None:
+            try:
+                fs = os.stat(path)
+            except OSError:
+                fs = None
+            if (fs is None or fs.st_mtime_ns != static.mtime_ns
+                    or fs.st_size != static.size):
+                with self.lock:
+                    if self.files.get(path) is static:
+                        self._remove(path)
+                static = None
+        with self.lock:
+            if static is None:
+                self.misses += 1
+            else:
+                if path in self.files:
+                    self.files.move_to_end(path)
+                self.hits += 1
+        return static
+
+    def _remove(self, path):
+        static = self.files.pop(path, None)
+        if static is not None:
+            self.size -= static.size
+
+
+class StaticIndex:
+    """Index of the static files under the directory root, used to know if a
+    file exists without accessing the file system."""
+
+    def __init__(self, root):
+        self.root = root
+        self.paths = frozenset()
+        self.build()
+
+    def __contains__(self, path):
+        return path in self.paths
+
+    def build(self):
+        """Walk the directory tree and store the paths of the files with an
+        extension (the only ones served as static files). Symbolic links to
+        directories are followed, unless they point to one of the
+        directories that contain them."""
+        paths = set()
+        # (path, (device, inode) of the directory and of its parents)
+        dirs = [(self.root, ())]
+        while dirs:
+            path, parents = dirs.pop()
+            try:
+                fs = os.stat(path)
+            except OSError:
+                continue
+            if (fs.st_dev, fs.st_ino) in parents:
+                # symbolic link cycle
+                continue
+            parents += ((fs.st_dev, fs.st_ino),)
+            try:
+                entries = os.scandir(path)
+            except OSError:
+                continue
+            with entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir():
+                            dirs.append((entry.path, parents))
+                        elif (entry.is_file()
+                                and os.path.splitext(entry.name)[1]):
+                            paths.add(entry.path)
+                    except OSError:
+                        pass
+        self.paths = frozenset(paths)
+
+
+@functools.lru_cache()
+def _template_parser():
+    """Return a subclass of patrom's TemplateParser whose generated code can
+    be compiled once and run for any key/values : patrom renders the
+    templates included by <py include="..."/> while parsing, with the
+    key/values of the rendering ; here the tag generates a call to _include()
+    that renders the included template when the code is run.
+
+    The tag also supports the attributes "cache" and "keys" : the output of
+    the included template is then kept in a FragmentCache for "cache"
+    seconds, for each combination of the values of the comma-separated
+    names in "keys".
+
+    The subclass relies on the attributes of patrom's parser used to build
+    the generated code (add(), py_tags, line_mapping, src) ; it was written
+    for patrom 0.0.1."""
+    import patrom
+
+    class TemplateParser(patrom.TemplateParser):
+
+        def __init__(self, *args, **kw):
+            super().__init__(*args, **kw)
+            self.includes = [] # paths of the included templates
+
+        def handle_startendtag(self, tag, attrs):
+            attrs = dict(attrs)
+            if (tag != self.PY_TAG or "include" not in attrs
+                    or not set(attrs) <= {"include", "cache", "keys"}):
+                return super().handle_startendtag(tag, attrs.items())
+            text = self.get_starttag_text()
+            path = os.path.normpath(os.path.join(
+                os.path.dirname(self.filename), attrs["include"].strip()))
+            keys = tuple(name.strip()
+                for name in (attrs.get("keys") or "").split(",")
+                if name.strip())
+            ttl = None
+            if "cache" in attrs:
+                try:
+                    ttl = float(attrs["cache"])
+                except (TypeError, ValueError):
+                    raise patrom.TemplateError("invalid cache duration : {}"
+                        .format(text), self, text)
+            self.includes.append(path)
+            self.add("_include({!r}, {!r}, {!r})".format(path, ttl, keys),
+                text)
+
+    return TemplateParser
+
+
+class CompiledTemplate:
+    """A template parsed by patrom, with its generated Python code compiled.
+    """
+
+    def __init__(self, path, mtime_ns, code, parser):
+        self.path = path
+        self.mtime_ns = mtime_ns
+        self.code = code
+        self.parser = parser
+
+    def error(self, exc, lineno=None):
+        """Return a patrom TemplateError for the exception exc, raised by
+        line lineno of the generated code, or while parsing the template if
+        lineno is None. The message gives the line in the template."""
+        from patrom import TemplateError
+        out = io.StringIO()
+        traceback.print_exception(type(exc), exc, exc.__traceback__,
+            file=out)
+        if lineno is None:
+            line, text = self.parser.getpos()[0], ""
+        else:
+            mapping = self.parser.line_mapping
+            while lineno and lineno not in mapping:
+                lineno -= 1
+            line, column, text = mapping.get(lineno, (0, 0, ""))
+        out.write("\nLine {} in template {}\n".format(line, self.path))
+        out.write(text)
+        return TemplateError(out.getvalue(), self.parser, text)
+
+
+class FragmentCache:
+    """Cache of the output of rendered templates, used by
+    dialog.cached_template() and by the templates included with a "cache"
+    attribute.
+
+    An entry is identified by the path of a template and the values of some
+    of its arguments (they must be hashable). It expires after ttl seconds
+    (the cache's ttl by default). When the total length of the cached output
+    exceeds max_size characters, the least recently used entries are removed.
+    """
+
+    def __init__(self, max_size=1 << 24, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.fragments = collections.OrderedDict() # key => (expires, text)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def clear(self):
+        """Remove all the fragments from the cache."""
+        with self.lock:
+            self.fragments.clear()
+            self.size = 0
+
+    def get(self, key):
+        """Return the text cached for key if it has not expired, or None."""
+        with self.lock:
+            entry = self.fragments.get(key)
+            if entry is not None and entry[0] <= time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.fragments.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def invalidate(self, path, **values):
+        """Remove the fragments of the template at path ; if values are
+        specified, only those whose key arguments have these values."""
+        with self.lock:
+            for key in list(self.fragments):
+                if key[0] == path:
+                    args = dict(key[1])
+                    if all(name in args and args[name] == value
+                            for name, value in values.items()):
+                        self._remove(key)
+
+    def key(self, path, keys, kw):
+        """Return the key for the template at path rendered with the
+        arguments kw, of which only those named in keys are used."""
+        return path, tuple((name, kw.get(name)) for name in sorted(keys))
+
+    def set(self, key, text, ttl=None):
+        """Store text for key, for ttl seconds."""
+        if len(text) > self.max_size:
+            return
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self.lock:
+            self._remove(key)
+            self.fragments[key] = (expires, text)
+            self.size += len(text)
+            while self.size > self.max_size:
+                self._remove(next(iter(self.fragments)))
+
+    def _remove(self, key):
+        entry = self.fragments.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+
+
+class TemplateCache:
+    """Cache of the templates compiled for dialog.template(), used if
+    application.template_cache is set to an instance of this class ;
+    otherwise, the templates are rendered by patrom's TemplateParser.render().
+
+    Each template file is parsed and compiled once ; rendering it only runs
+    the compiled code. If check_mtime is set, the modification time of the
+    file is checked at each rendering and the template is compiled again if
+    it has changed. At most max_size templates are kept : the least recently
+    used are then removed from the cache.
+
+    fragments is the FragmentCache used for the templates included with a
+    "cache" attribute ; if it is None, they are rendered every time.
+    """
+
+    def __init__(self, max_size=256, check_mtime=True, fragments=None):
+        self.max_size = max_size
+        self.check_mtime = check_mtime
+        self.fragments = fragments
+        self.templates = collections.OrderedDict() # path => CompiledTemplate
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def clear(self):
+        """Remove all the templates from the cache."""
+        with self.lock:
+            self.templates.clear()
+
+    def compile(self, path):
+        """Parse and compile the template file at path, store it in the
+        cache and return it. Errors are raised as patrom TemplateError."""
+        from patrom import TemplateError
+        mtime_ns = os.stat(path).st_mtime_ns
+        with open(path, encoding="utf-8") as fobj:
+            source = fobj.read()
+        parser = _template_parser()()
+        parser.filename = path
+        parser.kw = {}
+        try:
+            parser.feed(source)
+            parser.close()
+            if parser.py_tags: # unclosed <py> tags
+                value, text, (line, column) = parser.py_tags.pop()
+                raise TemplateError("Unclosed py tag line {} column {} : {}"
+                    .format(line, column, text), parser, text)
+            code = compile(parser.src, path, "exec")
+        except TemplateError:
+            raise
+        except Exception as exc:
+            # SyntaxError in the generated code, or error in the parser
+            lineno = exc.lineno if isinstance(exc, SyntaxError) else None
+            raise CompiledTemplate(path, mtime_ns, None, parser).error(exc,
+                lineno)
+        template = CompiledTemplate(path, mtime_ns, code, parser)
+        with self.lock:
+            self.templates[path] = template
+            self.templates.move_to_end(path)
+            while len(self.templates) > self.max_size:
+                self.templates.popitem(last=False)
+        return template
+
+    def get(self, path):
+        """Return the CompiledTemplate for path, compiling it if it is not in
+        the cache or if its file has changed."""
+        with self.lock:
+            template = self.templates.get(path)
+        if template is not None and self.check_mtime:
+            try:
+                mtime_ns = os.stat(path).st_mtime_ns
+            except OSError:
+                mtime_ns = None
+            if mtime_ns != template.mtime_ns:
+                template = None
+        with self.lock:
+            if template is None:
+                self.misses += 1
+            else:
+                if path in self.templates:
+                    self.templates.move_to_end(path)
+                self.hits += 1
+        if template is None:
+            template = self.compile(path)
+        return template
+
+    def precompile(self, paths):
+        """Compile the templates at paths, and the templates they include.
+        Return the number of compiled templates."""
+        paths = [os.path.normpath(path) for path in paths]
+        compiled = set()
+        while paths:
+            path = paths.pop()
+            if path not in compiled:
+                compiled.add(path)
+                paths += self.compile(path).parser.includes
+        return len(compiled)
+
+    def render(self, path, **kw):
+        """Render the template at path with the key/values in kw."""
+        out = io.StringIO()
+        self._run(self.get(path), kw, out)
+        return out.getvalue()
+
+    def _run(self, template, kw, out):
+        from patrom import TemplateError
+        namespace = dict(kw)
+        # the generated code produces the result with print()
+        namespace["print"] = functools.partial(print, file=out)
+        namespace["_include"] = functools.partial(self._include, kw=kw,
+            out=out)
+        try:
+            exec(template.code, namespace)
+        except TemplateError:
+            # raised by an included template
+            raise
+        except Exception as exc:
+            lineno = 0
+            for frame in traceback.extract_tb(exc.__traceback__):
+                if frame.filename == template.path:
+                    lineno = frame.lineno
+            raise template.error(exc, lineno)
+
+    def _include(self, path, ttl=None, keys=(), kw=None, out=None):
+        """Render the template included at path in out."""
+        if ttl is None or self.fragments is None:
+            self._run(self.get(path), kw, out)
+            return
+        key = self.fragments.key(path, keys, kw)
+        text = self.fragments.get(key)
+        if text is None:
+            buffer = io.StringIO()
+            self._run(self.get(path), kw, buffer)
+            text = buffer.getvalue()
+            self.fragments.set(key, text, ttl)
+        out.write(text)
+
+
+class CachedResponse:
+    """Status, headers and body of a response kept in a ResponseCache."""
+
+    def __init__(self, status, headers, body, ttl):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.ttl = ttl
+        self.expires = time.monotonic() + ttl
+        self.refreshing = False
+        self.variants = {} # encoding => compressed body
+
+
+class ResponseCache:
+    """Cache of the responses of the functions that have an attribute
+    "cache" (the number of seconds a response is kept), used if
+    application.response_cache is set to an instance of this class (the
+    default).
+
+    Responses with a body of at most max_body_size bytes are kept until the
+    total size of the cached bodies exceeds max_size : the least recently
+    used responses are then removed.
+
+    When a response has expired, the first request regenerates it ; until it
+    is done, the other requests get the expired response, if it has expired
+    for less than its duration.
+    """
+
+    def __init__(self, max_size=1 << 24, max_body_size=1 << 20):
+        self.max_size = max_size
+        self.max_body_size = max_body_size
+        self.responses = collections.OrderedDict() # key => CachedResponse
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def clear(self):
+        """Remove all the responses from the cache."""
+        with self.lock:
+            self.responses.clear()
+            self.size = 0
+
+    def get(self, key):
+        """Return a tuple (response, refresh). response is the
+        CachedResponse to send, or None if the response must be generated ;
+        in this case, refresh is True if the request regenerates an expired
+        response, and release() must be called if it is not stored."""
+        now = time.monotonic()
+        with self.lock:
+            cached = self.responses.get(key)
+            if cached is not None and now >= cached.expires:
+                if not cached.refreshing:
+                    cached.refreshing = True
+                    self.misses += 1
+                    return None, True
+                elif now >= cached.expires + cached.ttl:
+                    # too old to be sent while it is regenerated
+                    cached = None
+            if cached is None:
+                self.misses += 1
+                return None, False
+            self.responses.move_to_end(key)
+            self.hits += 1
+            return cached, False
+
+    def invalidate(self, url):
+        """Remove the responses for url."""
+        with self.lock:
+            for key in list(self.responses):
+                if key[1] == url:
+                    self._remove(key)
+
+    def release(self, key):
+        """Called when the response for key was not regenerated : another
+        request will try."""
+        with self.lock:
+            cached = self.responses.get(key)
+            if cached is not None:
+                cached.refreshing = False
+
+    def set(self, key, cached):
+        """Store the CachedResponse for key."""
+        size = len(cached.body)
+        if size > self.max_body_size or size > self.max_size:
+            return self.release(key)
+        with self.lock:
+            self._remove(key)
+            self.responses[key] = cached
+            self.size += size
+            while self.size > self.max_size:
+                self._remove(next(iter(self.responses)))
+
+    def _remove(self, key):
+        cached = self.responses.pop(key, None)
+        if cached is not None:
+            self.size -= len(cached.body)
+
+
+class Compression:
+    """Compression of the response bodies with gzip or deflate, used if
+    application.compression is set to an instance of this class.
+
+    A body is compressed if the client accepts one of these encodings
+    (header Accept-Encoding), if its content type is in types (a prefix
+    ending with "/" matches all the subtypes) and if it has at least min_size
+    bytes ; bodies sent by chunks are compressed as they are produced. level
+    is the zlib compression level.
+
+    Static files are sent from a precompressed file with the extension .gz
+    if it is not older than the file. Otherwise, the compressed versions of
+    the files of at most max_file_size bytes are kept in memory until their
+    total size exceeds cache_size : the least recently used are then
+    removed.
+    """
+
+    types = ["text/", "application/json", "application/javascript",
+        "application/xml", "application/xhtml+xml", "image/svg+xml"]
+    wbits = {"gzip": 16 + zlib.MAX_WBITS, "deflate": zlib.MAX_WBITS}
+
+    def __init__(self, min_size=1024, level=6, types=None,
+            max_file_size=1 << 22, cache_size=1 << 24):
+        self.min_size = min_size
+        self.level = level
+        if types is not None:
+            self.types = types
+        self.max_file_size = max_file_size
+        self.cache_size = cache_size
+        self.files = collections.OrderedDict() # (path, ...) => bytes
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def compress(self, data, encoding):
+        """Return data compressed with encoding."""
+        compressor = self.compressor(encoding)
+        return compressor.compress(data) + compressor.flush()
+
+    def compressible(self, ctype):
+        """Return True if a body of type ctype can be compressed."""
+        ctype = ctype.split(";")[0].strip().lower()
+        if ctype == "text/event-stream":
+            # events must be sent as they are produced
+            return False
+        return any(ctype.startswith(prefix) if prefix.endswith("/")
+            else ctype == prefix for prefix in self.types)
+
+    def compressor(self, encoding):
+        """Return a zlib compression object for encoding."""
+        return zlib.compressobj(self.level, zlib.DEFLATED,
+            self.wbits[encoding])
+
+    def negotiate(self, accept_encoding):
+        """Return the encoding to use for the value of the header
+        Accept-Encoding ("gzip", "deflate"), or None."""
+        if not accept_encoding:
+            return None
+        accepted = {}
+        for item in accept_encoding.lower().split(","):
+            coding, _, params = item.partition(";")
+            quality = 1.0
+            params = params.strip()
+            if params.startswith("q="):
+                try:
+                    quality = float(params[2:])
+                except ValueError:
+                    quality = 0.0
+            accepted[coding.strip()] = quality
+        for encoding in ["gzip", "deflate"]:
+            if accepted.get(encoding, accepted.get("*", 0)) > 0:
+                return encoding
+        return None
+
+    def static(self, static, fobj, encoding):
+        """Return the content of the StaticFile static, read from the file
+        object fobj, compressed with encoding."""
+        key = (static.path, static.mtime_ns, static.size, encoding)
+        with self.lock:
+            data = self.files.get(key)
+            if data is not None:
+                self.files.move_to_end(key)
+                return data
+        data = self.compress(fobj.read(), encoding)
+        if len(data) <= self.cache_size:
+            with self.lock:
+                if key not in self.files:
+                    self.files[key] = data
+                    self.size += len(data)
+                while self.size > self.cache_size:
+                    self.size -= len(self.files.popitem(last=False)[1])
+        return data
+
+
+def _add_vary(headers, name):
+    """Add name to the header Vary."""
+    vary = headers["Vary"]
+    if vary is None:
+        headers["Vary"] = name
+    elif name.lower() not in [value.strip().lower()
+            for value in vary.split(",")]:
+        headers.replace_header("Vary", vary + ", " + name)
+
+
+def _weak_etag(headers):
+    """Make the header ETag weak, for a compressed body."""
+    etag = headers["ETag"]
+    if etag is not None and not etag.startswith("W/"):
+        headers.replace_header("ETag", "W/" + etag)
+
+
+# types of compressed files, as in http.server.SimpleHTTPRequestHandler
+_extensions_map = {".gz": "application/gzip", ".Z": "application/octet-stream",
+    ".bz2": "application/x-bzip2", ".xz": "application/x-xz"}
+
+def _guess_type(path):
+    """Return the content type of the file at path."""
+    ext = os.path.splitext(path)[1]
+    if ext in _extensions_map:
+        return _extensions_map[ext]
+    ext = ext.lower()
+    if ext in _extensions_map:
+        return _extensions_map[ext]
+    return mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+
+def _parse_ranges(value, size):
+    """Parse the value of a Range header for a file of the given size.
+    Return the list of (first byte, last byte) to send, sorted and with
+    overlapping ranges merged, or an empty list if none of the ranges can
+    be satisfied. Return None if the value is invalid : the header is then
+    ignored."""
+    unit, sep, specs = value.partition("=")
+    if unit.strip().lower() != "bytes" or not sep:
+        return None
+    ranges = []
+    nb_specs = 0
+    for spec in specs.split(","):
+        spec = spec.strip()
+        if not spec:
+            continue
+        nb_specs += 1
+        mo = re.match(r"^(\d*)\s*-\s*(\d*)$", spec, flags=re.A)
+        if mo is None or mo.groups() == ("", ""):
+            return None
+        first, last = mo.groups()
+        if not first:
+            # suffix range : the last bytes of the file
+            length = int(last)
+            if length and size:
+                ranges.append((max(size - length, 0), size - 1))
+            continue
+        first = int(first)
+        if last and int(last) < first:
+            return None
+        if first < size:
+            last = size - 1 if not last else min(int(last), size - 1)
+            ranges.append((first, last))
+    if not nb_specs:
+        return None
+    ranges.sort()
+    merged = []
+    for first, last in ranges:
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+    return merged
+
+
+async def _await(awaitable):
+    return await awaitable
 
 
 class Dialog:
     """Instances of Dialog are passed as arguments to the script functions.
-    They have attributes taken from the application instance."""
+    They give access to the request and response of the application
+    instance, and to the attributes shared by all requests."""
+
+    __slots__ = ["_app", "request", "response", "__dict__"]
+
+    error = HttpError
+    event_stream = EventStream
+    redirection = HttpRedirection
 
     def __init__(self, obj):
-        self.environ = obj.env
-        self.error = HttpError
-        self.redirection = HttpRedirection
+        self._app = obj
         self.request = obj.request
         self.response = obj.response
-        self.root = obj.root
-        self.routes = obj.routes
-        self.template = obj.template
+
+    @property
+    def environ(self):
+        return self._app.env
+
+    @property
+    def root(self):
+        return application.root
+
+    @property
+    def routes(self):
+        return application.routes
+
+    @property
+    def websocket(self):
+        return self._app.websocket
+
+    def cached_template(self, filename, keys=(), ttl=None, **kw):
+        return self._app.cached_template(filename, keys, ttl, **kw)
+
+    def template(self, filename, **kw):
+        return self._app.template(filename, **kw)
 
 
 class ImportTracker:
@@ -91,57 +1644,79 @@ tracker = ImportTracker()
 sys.meta_path.insert(0, tracker)
 
 
-class application(http.server.SimpleHTTPRequestHandler):
-    """WSGI entry point"""
+class application:
+    """WSGI entry point. An instance is created for each request ; the state
+    shared by all requests (routes, options...) is stored in class
+    attributes."""
+
+    __slots__ = ["env", "start_response", "request", "response", "status",
+        "prepared", "deferred", "pending", "websocket", "url", "cache_key"]
 
     debug = False
     error = None
     registered = []
     root = os.getcwd()
+    static_cache = None
+    static_index = None
+    compression = None
+    fragment_cache = FragmentCache()
+    response_cache = ResponseCache()
+    template_cache = None
+    lock = threading.Lock()
+    # name of the module whose namespace holds the registered modules
+    main = "__main__"
 
     def __init__(self, environ, start_response):
 
         self.env = environ
         self.start_response = start_response
 
-        # Set attributes for logging
-        path = self.env["PATH_INFO"]
-        if self.env["QUERY_STRING"]:
-            path += "?" + self.env["QUERY_STRING"]
-
-        self.request_version = self.env["SERVER_PROTOCOL"]
-        self.requestline = "{} {} {}".format(self.env["REQUEST_METHOD"],
-            path, self.request_version)
-        self.client_address = [self.env["REMOTE_ADDR"],
-            self.env.get("REMOTE_PORT", self.env["SERVER_PORT"])]
-
-        # Initialise attribute "request" from data sent by user agent
-        self.request = request = Message()
-        request.url = self.env["PATH_INFO"]
-        request.method = self.env["REQUEST_METHOD"]
-
-        for key in self.env:
-            if key == "HTTP_COOKIE":
-                request.cookies = http.cookies.SimpleCookie(self.env[key])
-            elif key.startswith("HTTP_"):
-                request.headers[key[5:].replace('_', '-')] = self.env[key]
-            elif key.upper() == "CONTENT_LENGTH":
-                request.headers["Content-Length"] = self.env[key]
-            elif key.upper() == "CONTENT_TYPE":
-                request.headers["Content-Type"] = self.env[key]
+        # Initialise attribute "request" from data sent by user agent : it is
+        # parsed when it is used
+        self.request = Request(self.env)
 
         # Initialise attribute "response"
         self.response = Message()
-        self.response.encoding = "utf-8"
 
         self.status = "200 Ok"
+        self.prepared = False
+        # set by the ASGI entry point : results of async functions are
+        # awaited by the event loop
+        self.deferred = False
+        self.pending = None
+        self.websocket = None
+        # (key, duration) if the response is stored in response_cache
+        self.cache_key = None
 
     def __iter__(self):
         """Iteration expected by the WSGI protocol. Calls start_response
         then yields the response body.
         """
+        self.prepare()
+        body = self.response.body
+        if isinstance(body, bytes):
+            yield body
+        else:
+            yield from body
+
+    def close(self):
+        """Called by the WSGI server when the response is sent."""
+        if hasattr(self.response.body, "close"):
+            self.response.body.close()
+
+    def prepare(self):
+        """Process the request and call start_response. The response body is
+        set in self.response.body."""
+        if self.prepared:
+            return
+        self.prepared = True
+        self.process()
+        self.start()
+
+    def process(self):
+        """Process the request : set the response status, headers and body.
+        """
         try:
-            self.get_request_fields()
             self.handle()
         except:
             out = io.StringIO()
@@ -149,13 +1724,17 @@ class application(http.server.SimpleHTTPRequestHandler):
             self.response.headers.set_type("text/plain")
             self.response.body = out.getvalue().encode(self.response.encoding)
 
+    def start(self):
+        """Call start_response with the response status and headers."""
+        self.compress()
         # 2nd argument of start_response is a list of (key, value) pairs
         headers = [(k, str(v)) for (k, v) in self.response.headers.items()]
-        for morsel in self.response.cookies.values():
-            headers.append(("Set-Cookie", morsel.output(header="").lstrip()))
+        if self.response._cookies is not None:
+            for morsel in self.response._cookies.values():
+                headers.append(("Set-Cookie",
+                    morsel.output(header="").lstrip()))
 
         self.start_response(str(self.status), headers)
-        yield self.response.body
 
     @classmethod
     def check_changes(cls):
@@ -177,87 +1756,15 @@ class application(http.server.SimpleHTTPRequestHandler):
 
         threading.Timer(2.0, cls.check_changes).start()
 
-    def done(self, code, infile):
-        """Send response, cookies, response headers and the data read from
-        infile.
+    def done(self, code, body=b""):
+        """Set the response status and body. body is either bytes, or an
+        iterable sent by blocks (files, iterators).
         """
         self.status = "{} {}".format(code,
             http.server.BaseHTTPRequestHandler.responses[code])
         if code == 500:
             self.response.headers.set_type("text/plain")
-        infile.seek(0)
-        self.response.body = infile.read()
-
-    def get_request_fields(self):
-        """Set self.request.fields, a dictionary indexed by field names.
-        If field name ends with [], the value is a list of values.
-        Else, it is a single value, or a list if there are several values.
-        """
-        request = self.request
-        request.fields = {}
-
-        # Get request fields from query string
-        fields = urllib.parse.parse_qs(self.env.get("QUERY_STRING", ""),
-            keep_blank_values=1)
-
-        for key in fields:
-            if key.endswith("[]"):
-                request.fields[key[:-2]] = fields[key]
-            elif len(fields[key]) == 1:
-                request.fields[key] = fields[key][0]
-            else:
-                request.fields[key] = fields[key]
-
-        if request.method in ["POST", "PUT", "DELETE", "PATCH"]:
-            # Get encoding of request data
-            charset = "iso-8859-1"
-            for key in request.headers:
-                mo = re.search(r"charset\s*=(.*)$", request.headers[key])
-                if mo:
-                    charset = mo.groups()[0]
-                    break
-            request.encoding = charset
-
-            fp = self.env["wsgi.input"]
-
-            has_keys = True
-            if "Content-Type" in request.headers:
-                ctype = request.headers["Content-Type"]
-                has_keys = ctype == "application/x-www-form-urlencoded" or \
-                    ctype.startswith("multipart/")
-
-            # If data is not structured with key and value (eg JSON content),
-            # only read raw data and set attributes "raw" and "json" of the
-            # request object.
-            if not has_keys:
-                length = int(request.headers["Content-Length"])
-                request.raw = fp.read(length)
-                def _json():
-                    return json.loads(request.raw.decode(charset))
-                request.json = _json
-                return
-
-            # Update request fields from POST data
-            body = cgi.FieldStorage(fp, headers=request.headers,
-                environ={"REQUEST_METHOD": "POST"})
-
-            data = {}
-            for k in body.keys():
-                if isinstance(body[k], list): # several fields with same name
-                    values = [x if x.file else x.value for x in body[k]]
-                    if k.endswith('[]'):
-                        data[k[:-2]] = values
-                    else:
-                        data[k] = values
-                else:
-                    if body[k].filename: # file upload : don't read the value
-                        data[k] = body[k]
-                    else:
-                        if k.endswith('[]'):
-                            data[k[:-2]] = [body[k].value]
-                        else:
-                            data[k] = body[k].value
-            request.fields.update(data)
+        self.response.body = body
 
     @classmethod
     def get_registered(cls):
@@ -268,8 +1775,8 @@ class application(http.server.SimpleHTTPRequestHandler):
         if cls.registered:
             # registered modules are cached in a class attribute
             return cls.registered
-        main = sys.modules["__main__"]
-        cls.registered = [main]
+        main = sys.modules[cls.main]
+        registered = [main]
 
         for key in dir(main):
             if key.startswith("_"):
@@ -279,9 +1786,12 @@ class application(http.server.SimpleHTTPRequestHandler):
                     and getattr(obj, "__register__", True)
                     and hasattr(obj, "__file__")
                     and obj.__file__.startswith(os.getcwd())):
-                cls.registered.append(obj)
+                registered.append(obj)
 
-        return cls.registered
+        # set the class attribute when the list is complete, for requests
+        # served in other threads
+        cls.registered = registered
+        return registered
 
     def handle(self):
         """Process the data received"""
@@ -291,12 +1801,10 @@ class application(http.server.SimpleHTTPRequestHandler):
             # change in some file failed. application.changed is the name of
             # this file. It is set in method check_changes().
             msg = "Error reloading {}".format(application.changed)
-            return self.done(500, io.BytesIO(msg.encode("utf-8")))
+            return self.done(500, msg.encode("utf-8"))
 
         response = self.response
-        self.elts = urllib.parse.urlparse(self.env["PATH_INFO"] +
-            "?" + self.env["QUERY_STRING"])
-        self.url = self.elts[2]
+        self.url = urllib.parse.urlparse(self.env["PATH_INFO"])[2]
 
         # special url "__doc__" returns a JSON object with documentation
         if self.url == "/__doc__":
@@ -309,42 +1817,65 @@ class application(http.server.SimpleHTTPRequestHandler):
                 })
             self.response.headers.set_type('application/json')
             res = json.dumps(doc, indent=4)
-            return self.done(200, io.BytesIO(res.encode("utf-8")))
+            return self.done(200, res.encode("utf-8"))
 
         # default content type is text/html
         response.headers.set_type("text/html")
 
         method = self.request.method.lower()
+        if (method == "get"
+                and self.env.get("HTTP_UPGRADE", "").lower() == "websocket"):
+            # WebSocket opening handshake : served by a method "websocket"
+            method = "websocket"
         kind, arg = self.resolve(method, self.url)
 
         if kind is None:
             # If self.url doesn't end with '/' and if self.url + '/' is mapped
             # to a function, redirect to self.url + '/'
-            if not self.url.endswith('/'):
+            if not self.url.endswith('/') and method != "websocket":
                 kind, arg = self.resolve(method, self.url + '/')
                 if kind not in [None, 'file']:
                     self.response.headers["Location"] = self.url + '/'
-                    return self.done(302, io.BytesIO())
+                    return self.done(302)
 
             return self.send_error(404, "File not found",
                 "No route for {} with method {}".format(self.url, method))
 
         if kind == 'file':
-            if not os.path.exists(arg):
-                return self.send_error(404, "File not found",
-                    "No file matching {}".format(self.url))
             return self.send_static(arg)
 
         func, kw = arg
-        self.request.fields.update(kw)
+        self.request.url_fields = kw
+        self.request.stream_parts = getattr(func, "stream_parts", False)
+
+        if method == "websocket":
+            return self.serve_websocket(func)
+
+        ttl = getattr(func, "cache", None)
+        if (ttl and method in ["get", "head"]
+                and application.response_cache is not None):
+            return self.render_cached(func, ttl)
 
         # Run function
         return self.render(func)
 
     @classmethod
     def load_routes(cls):
-        """Build the mapping between url patterns and functions"""
-        cls.routes = {}
+        """Build the mapping between url patterns and functions, and the
+        dispatch structures used by resolve().
+
+        The new mapping replaces the previous one when it is complete, so
+        that requests served in other threads never see a partial mapping.
+        """
+        with cls.lock:
+            routes, dispatch = {}, {}
+            cls._load_routes(routes, dispatch)
+            cls.routes, cls.dispatch = routes, dispatch
+
+    @classmethod
+    def _load_routes(cls, routes, dispatch):
+        """Add the routes defined in registered modules to routes and
+        dispatch."""
         for module in cls.get_registered():
             prefix = ""
             if hasattr(module, "__prefix__"):
@@ -368,7 +1899,8 @@ class application(http.server.SimpleHTTPRequestHandler):
                 for attr in dir(obj):
                     method = getattr(obj, attr)
                     if not (isinstance(method, types.FunctionType)
-                            and attr.upper() in http_methods):
+                            and (attr.upper() in http_methods
+                                or attr == "websocket")):
                         continue
                     method_urls = getattr(method, "urls",
                         [getattr(method, "url", None)])
@@ -376,30 +1908,15 @@ class application(http.server.SimpleHTTPRequestHandler):
                         method_urls = class_urls
                     for method_url in method_urls:
                         method_url = "/" + (prefix + method_url).lstrip("/")
-                        # Regular expression for smart urls
-                        pattern = re.sub("<(.*?)>", r"(?P<\1>[^/]+?)",
-                            method_url)
-                        # A pattern is the tuple (request method, url regexp)
-                        pattern = (attr.lower(), "^" + pattern +"$")
-                        if pattern in cls.routes:
-                            # duplicate route : raise RoutingError
-                            msg = ('duplicate mapping for "{} {}":'
-                                        +"\n - in {} line {}" * 2)
-                            obj2 = cls.routes[pattern]
-                            raise RoutingError(msg.format(attr.upper(),
-                                method_url,
-                                obj2.__code__.co_filename,
-                                obj2.__code__.co_firstlineno,
-                                method.__code__.co_filename,
-                                method.__code__.co_firstlineno))
-
-                        cls.routes[pattern] = method
+                        cls.add_route(attr.lower(), method_url, method,
+                            routes, dispatch)
 
                     if (key.lower() == "index"
                             and not hasattr(method, "url")
-                            and (attr.lower(), "^/$") not in cls.routes):
+                            and (attr.lower(), "^/$") not in routes):
                         # Map path "/" to function "index"
-                        cls.routes[(attr.lower(), "^/$")] = method
+                        cls.add_route(attr.lower(), "/", method, routes,
+                            dispatch)
 
             for name, function in functions:
                 urls = getattr(function, "urls",
@@ -409,48 +1926,182 @@ class application(http.server.SimpleHTTPRequestHandler):
                 for url in urls:
                     url = "/" + (prefix + url).lstrip("/")
                     for method in methods:
-                        # Regular expression for smart urls
-                        pattern = re.sub("<(.*?)>", r"(?P<\1>[^/]+?)", url)
-                        # A pattern is the tuple (request method, url regexp)
-                        pattern = (method, "^" + pattern + "$")
-                        if pattern in cls.routes:
-                            # duplicate route : raise RoutingError
-                            msg = ('duplicate mapping for "{} {}":'
-                                        +"\n - in {} line {}" * 2)
-                            obj2 = cls.routes[pattern]
-                            raise RoutingError(msg.format(method.upper(),
-                                url,
-                                obj2.__code__.co_filename,
-                                obj2.__code__.co_firstlineno,
-                                function.__code__.co_filename,
-                                function.__code__.co_firstlineno))
-
-                        cls.routes[pattern] = function
+                        cls.add_route(method, url, function, routes,
+                            dispatch)
 
                         if (name.lower() == "index"
                                 and not hasattr(function, "url")
-                                and (method, "^/$") not in cls.routes):
+                                and (method, "^/$") not in routes):
                             # Map path "/" to function "index"
-                            cls.routes[(method, "^/$")] = function
+                            cls.add_route(method, "/", function, routes,
+                                dispatch)
+
+    @classmethod
+    def add_route(cls, method, url, obj, routes=None, dispatch=None):
+        """Map the tuple (method, url) to the function obj. Raise
+        RoutingError if the route is already defined, or if the url pattern
+        matches the same urls as a pattern mapped to another function.
+
+        routes and dispatch are the mappings to update, by default those of
+        the application."""
+        if routes is None:
+            routes, dispatch = cls.routes, cls.dispatch
+        # Regular expression for smart urls
+        pattern = re.sub("<(.*?)>", r"(?P<\1>[^/]+?)", url)
+        # A pattern is the tuple (request method, url regexp)
+        pattern = (method, "^" + pattern + "$")
+        msg = ('{} mapping for "{} {}":' + "\n - in {} line {}" * 2)
+        if pattern in routes:
+            # duplicate route : raise RoutingError
+            obj2 = routes[pattern]
+            raise RoutingError(msg.format("duplicate", method.upper(), url,
+                obj2.__code__.co_filename,
+                obj2.__code__.co_firstlineno,
+                obj.__code__.co_filename,
+                obj.__code__.co_firstlineno))
+        index = dispatch.setdefault(method, RouteIndex())
+        other = index.overlaps(url)
+        if other is not None:
+            # ambiguous route : some urls would match both patterns
+            obj2 = index.find(other)
+            raise RoutingError(msg.format("ambiguous", method.upper(),
+                "{} and {}".format(other, url),
+                obj2.__code__.co_filename,
+                obj2.__code__.co_firstlineno,
+                obj.__code__.co_filename,
+                obj.__code__.co_firstlineno))
+        index.add(url, obj)
+        routes[pattern] = obj
 
     def render(self, func):
-        """Run the function and send its result."""
+        """Run the function and send its result.
+
+        If the function has an attribute "etag" or "last_modified" that is a
+        function, it is called with the dialog object before the function,
+        to get the validator of the response : if the version in the browser
+        cache is still valid, a response 304 is sent without running the
+        function. If the attribute "etag" is True, the ETag is computed from
+        the response body."""
+        etag = getattr(func, "etag", None)
+        last_modified = getattr(func, "last_modified", None)
+        if etag is not None or last_modified is not None:
+            try:
+                if callable(etag):
+                    self.response.etag = etag(Dialog(self))
+                elif etag:
+                    self.response.etag = True
+                if callable(last_modified):
+                    self.response.last_modified = last_modified(Dialog(self))
+            except:
+                return self.send_traceback()
+            if self.send_validators():
+                return
         try:
             # run function with Dialog(self) as positional argument
             result = func(Dialog(self))
-            if isinstance(result, HttpRedirection):
-                self.response.headers["Location"] = result.url
-                return self.done(302, io.BytesIO())
-            elif isinstance(result, HttpError):
-                return self.done(result.code, io.BytesIO())
+            if inspect.isawaitable(result):
+                # async function
+                if self.deferred:
+                    # awaited by the ASGI event loop, which then calls
+                    # send_result()
+                    self.pending = result
+                    return
+                result = asyncio.run(_await(result))
         except: # exception : print traceback
-            result = io.StringIO()
-            if application.debug:
-                traceback.print_exc(file=result)
-                result = result.getvalue() # string
-            else:
-                result = "Server error"
-            return self.send_error(500, "Server error", result)
+            return self.send_traceback()
+        self.send_result(result)
+
+    def render_cached(self, func, ttl):
+        """Send the response stored in application.response_cache for the
+        request, or run the function and store its response. The key is
+        built from the method, the url, the request fields and the request
+        headers listed in the function attribute "vary"."""
+        vary = getattr(func, "vary", [])
+        if vary:
+            self.response.headers["Vary"] = ", ".join(vary)
+        try:
+            fields = tuple(sorted((name, tuple(value)
+                if isinstance(value, list) else value)
+                for name, value in self.request.fields.items()))
+        except Exception:
+            # malformed request : error sent by render()
+            return self.render(func)
+        key = (self.request.method, self.url, fields,
+            tuple(self.request.headers.get(name) for name in vary))
+        cached, refresh = application.response_cache.get(key)
+        if cached is not None:
+            self.status = cached.status
+            self.response.headers = Headers(cached.headers)
+            self.response.body = cached.body
+            if not self.validate():
+                self.compress(cached.variants)
+            return
+        self.cache_key = (key, ttl)
+        self.render(func)
+        if self.pending is None:
+            # else, called by the ASGI entry point when the result of the
+            # async function is sent
+            self.cache_response()
+
+    def cache_response(self):
+        """Store the response in application.response_cache if it can be
+        shared : status 200, body in memory and no cookie."""
+        key, ttl = self.cache_key
+        cache = application.response_cache
+        if (self.status.startswith("200 ")
+                and isinstance(self.response.body, bytes)
+                and not self.response._cookies):
+            cache.set(key, CachedResponse(self.status,
+                self.response.headers.items(), self.response.body, ttl))
+        else:
+            cache.release(key)
+
+    def compress(self, variants=None):
+        """Compress the response body if application.compression is set and
+        the client accepts it. variants is a dictionary used to store the
+        compressed bodies by encoding."""
+        compression = application.compression
+        headers = self.response.headers
+        if (compression is None or not self.status.startswith("200 ")
+                or self.request.method == "HEAD"
+                or "Content-Encoding" in headers
+                or not compression.compressible(headers["Content-Type"]
+                    or "")):
+            return
+        body = self.response.body
+        if isinstance(body, bytes):
+            if len(body) < compression.min_size:
+                return
+        elif not isinstance(body, StreamBody):
+            # files and event streams
+            return
+        _add_vary(headers, "Accept-Encoding")
+        encoding = compression.negotiate(
+            self.request.headers["Accept-Encoding"])
+        if encoding is None:
+            return
+        del headers["Content-Length"]
+        if isinstance(body, bytes):
+            data = variants.get(encoding) if variants is not None else None
+            if data is None:
+                data = compression.compress(body, encoding)
+                if variants is not None:
+                    variants[encoding] = data
+            self.response.body = data
+            headers["Content-Length"] = str(len(data))
+        else:
+            self.response.body = CompressedBody(body,
+                compression.compressor(encoding))
+        headers["Content-Encoding"] = encoding
+        _weak_etag(headers)
+
+    def send_result(self, result):
+        """Send the result of a function."""
+        if isinstance(result, HttpRedirection):
+            self.response.headers["Location"] = result.url
+            return self.done(302)
+        elif isinstance(result, HttpError):
+            return self.done(result.code)
 
         # Get response encoding
         encoding = self.response.encoding
@@ -460,26 +2111,130 @@ class application(http.server.SimpleHTTPRequestHandler):
                 self.response.headers.replace_header("Content-Type",
                     ctype + "; charset={}".format(encoding))
 
-        # Build response body as a bytes stream
-        output = io.BytesIO()
+        response_code = getattr(self.response, "status", 200)
 
-        if self.request.method != "HEAD":
-            if isinstance(result, bytes):
-                output.write(result)
-            elif isinstance(result, str):
-                try:
-                    output.write(result.encode(encoding))
-                except UnicodeEncodeError:
-                    msg = io.StringIO()
-                    traceback.print_exc(file=msg)
-                    return self.done(500,
-                        io.BytesIO(msg.getvalue().encode("ascii")))
-            else:
-                output.write(str(result).encode(encoding))
+        if isinstance(result, EventStream):
+            self.response.headers.set_type("text/event-stream")
+            self.response.headers["Cache-Control"] = "no-cache"
+            # ask proxies (nginx) not to buffer the events
+            self.response.headers["X-Accel-Buffering"] = "no"
 
-        response_code = getattr(self.response, "status", 200)
-        self.response.headers["Content-Length"] = output.tell()
-        self.done(response_code, output)
+        if self.request.method == "HEAD":
+            if hasattr(result, "close"):
+                result.close()
+            if response_code == 200 and self.send_validators():
+                return
+            self.response.headers["Content-Length"] = "0"
+            return self.done(response_code)
+        elif isinstance(result, EventStream):
+            return self.done(response_code, EventStreamBody(result))
+        elif hasattr(result, "read"):
+            # file object : send it by blocks
+            body = _file_body(result)
+            if body is not None:
+                self.response.headers["Content-Length"] = str(body.length)
+                return self.done(response_code, body)
+            return self.done(response_code, StreamBody(result, encoding))
+        elif hasattr(result, "__next__"):
+            # generator or iterator : send the chunks as they are produced
+            return self.done(response_code, StreamBody(result, encoding))
+
+        # Encode the response body
+        if isinstance(result, bytes):
+            body = result
+        else:
+            if not isinstance(result, str):
+                result = str(result)
+            try:
+                body = result.encode(encoding)
+            except UnicodeEncodeError:
+                msg = io.StringIO()
+                traceback.print_exc(file=msg)
+                return self.done(500, msg.getvalue().encode("ascii"))
+
+        self.response.headers["Content-Length"] = str(len(body))
+        if response_code == 200 and self.send_validators(body):
+            return
+        self.done(response_code, body)
+
+    def send_validators(self, body=None):
+        """Set the headers ETag and Last-Modified from the validators of
+        the response (body is used if the ETag is computed from the body),
+        then send a response 304 and return True if the version in the
+        browser cache is still valid."""
+        if self.request.method not in ["GET", "HEAD"]:
+            return False
+        response = self.response
+        headers = response.headers
+        etag = response.etag
+        if etag is True:
+            etag = None if body is None else '"{}"'.format(
+                hashlib.sha1(body).hexdigest())
+        if etag is not None:
+            etag = str(etag)
+            if not etag.startswith(('"', 'W/"')):
+                etag = '"{}"'.format(etag)
+            del headers["ETag"]
+            headers["ETag"] = etag
+        last_modified = response.last_modified
+        if last_modified is not None:
+            if isinstance(last_modified, datetime.datetime):
+                last_modified = last_modified.timestamp()
+            del headers["Last-Modified"]
+            headers["Last-Modified"] = email.utils.formatdate(last_modified,
+                usegmt=True)
+        return self.validate()
+
+    def validate(self):
+        """If the response has the headers ETag or Last-Modified, and the
+        version in the browser cache is still valid, send a response 304
+        and return True."""
+        headers = self.response.headers
+        etag, mtime = headers["ETag"], None
+        if headers["Last-Modified"] is not None:
+            try:
+                mtime = email.utils.parsedate_to_datetime(
+                    headers["Last-Modified"]).timestamp()
+            except (TypeError, IndexError, OverflowError, ValueError):
+                pass
+        if (etag is None and mtime is None) or not self.not_modified(etag,
+                mtime):
+            return False
+        del headers["Content-Length"]
+        self.done(304)
+        return True
+
+    def serve_websocket(self, func):
+        """Complete the WebSocket opening handshake, then run the function,
+        which exchanges messages with dialog.websocket. The connection is
+        closed when the function returns."""
+        accept = self.env.get("bihan.websocket")
+        if accept is None or "HTTP_SEC_WEBSOCKET_KEY" not in self.env:
+            return self.send_error(400, "Bad Request",
+                "WebSocket connections are not supported by the server")
+        self.websocket = accept()
+        self.done(101)
+        try:
+            func(Dialog(self))
+        except Exception:
+            traceback.print_exc(file=self.env.get("wsgi.errors", sys.stderr))
+            self.websocket.close(1011)
+        finally:
+            self.websocket.close()
+
+    def send_traceback(self):
+        """Send an error response for the exception being handled : 400 if
+        the request body is malformed, 500 otherwise."""
+        if isinstance(sys.exc_info()[1], (MultipartError, RequestBodyError)):
+            # the request body can't be parsed
+            return self.send_error(400, "Bad Request", str(sys.exc_info()[1]))
+        result = io.StringIO()
+        if application.debug:
+            traceback.print_exc(file=result)
+            result = result.getvalue() # string
+        else:
+            result = "Server error"
+        return self.send_error(500, "Server error", result)
 
     def resolve(self, method, url):
         """If url matches a route defined for the application, return the
@@ -497,33 +2252,46 @@ class application(http.server.SimpleHTTPRequestHandler):
         # If last element has an extension, treat it as a file
         if os.path.splitext(elts[-1])[1]:
             path = os.path.join(self.root, *elts)
-            if os.path.exists(path):
+            index = application.static_index
+            if index is not None:
+                exists = path in index
+            else:
+                exists = os.path.exists(path)
+            if exists:
                 return 'file', path
             else:
                 return None, None
 
-        target, patterns = None, []
-        for (_method, pattern), obj in application.routes.items():
-            if _method != method:
-                continue
-            mo = re.match(pattern, url, flags=re.I)
-            if mo:
-                patterns.append(pattern)
-                if target is not None:
-                    # exception if more than one pattern matches the url
-                    msg = "url {} matches at least 2 patterns : {}"
-                    raise DispatchError(msg.format(url, patterns))
-                target = (obj, mo.groupdict())
-
-        if target is not None:
-            return 'func', target
+        index = application.dispatch.get(method)
+        if index is not None:
+            target = index.match(url)
+            if target is not None:
+                return 'func', target
 
         return None, None
 
     @classmethod
-    def run(cls, host="localhost", port=8000, debug=False):
+    def run(cls, host="localhost", port=8000, debug=False,
+            static_index=False, static_index_refresh=None, mode=None,
+            workers=None, backlog=None, queue_size=None, processes=None,
+            max_requests=None, freeze_gc=True, reuse_port=False,
+            keep_alive=False, keep_alive_timeout=5, keep_alive_requests=100,
+            server=None, precompile_templates=None):
         """Start the built-in server"""
-        cls.httpd = wsgiref.simple_server.make_server(host, port, application)
+        if debug not in [True, False]:
+            raise ValueError("debug must be True or False")
+        if processes and debug:
+            raise ValueError("debug mode can't be used with processes")
+        make_server = functools.partial(_server.make_server, host, port,
+            application, mode=mode, workers=workers, backlog=backlog,
+            queue_size=queue_size, reuse_port=reuse_port,
+            keep_alive=keep_alive, keep_alive_timeout=keep_alive_timeout,
+            keep_alive_requests=keep_alive_requests, server=server)
+        if processes and reuse_port:
+            # each process has its own socket, bound to the same port
+            cls.httpd = None
+        else:
+            cls.httpd = make_server()
         print("Serving on port {}".format(port))
         if len(sys.argv) > 1:
             # If there is a second argument in sys.argv, it is the id of a
@@ -535,12 +2303,50 @@ class application(http.server.SimpleHTTPRequestHandler):
             pid = sys.argv[1]
             os.kill(int(pid), signal.SIGTERM)
         cls.load_routes()
-        if debug not in [True, False]:
-            raise ValueError("debug must be True or False")
         cls.debug = debug
         if cls.debug:
             cls.check_changes()
-        cls.httpd.serve_forever()
+        if static_index:
+            cls.static_index = StaticIndex(cls.root)
+        if precompile_templates:
+            if cls.template_cache is None:
+                raise ValueError("precompile_templates requires "
+                    "application.template_cache")
+            # before the processes are forked : they share the templates
+            cls.template_cache.precompile([os.path.join(cls.root,
+                "templates", filename) for filename in precompile_templates])
+
+        def refresh():
+            if static_index and static_index_refresh:
+                cls.refresh_static_index(static_index_refresh)
+
+        if processes:
+            # Routes are loaded : the processes share them
+            _server.serve_prefork(cls.httpd or make_server, processes,
+                max_requests=max_requests, freeze_gc=freeze_gc, init=refresh)
+        else:
+            refresh()
+            cls.httpd.serve_forever()
+
+    @classmethod
+    def refresh_static_index(cls, interval=None):
+        """Rebuild the index of static files. If interval is set, rebuild it
+        every interval seconds, the first time in interval seconds (the
+        index was built when it was created)."""
+        if cls.static_index is None:
+            raise RuntimeError("application.static_index is not set")
+        if interval is None:
+            cls.static_index.build()
+            return
+
+        def refresh():
+            if cls.static_index is not None:
+                cls.static_index.build()
+                cls.refresh_static_index(interval)
+
+        timer = threading.Timer(interval, refresh)
+        timer.daemon = True
+        timer.start()
 
     def send_error(self, code, expl, msg=""):
         """Send an error message"""
@@ -552,53 +2358,203 @@ class application(http.server.SimpleHTTPRequestHandler):
 
     def send_static(self, fs_path):
         """Send the content of a file"""
-        try:
-            f = open(fs_path, 'rb')
-            fs = os.fstat(f.fileno())
-        except IOError:
-            return self.send_error(404, "File not found",
-                "No file found for given url")
+        cache = application.static_cache
+        static = cache.get(fs_path) if cache is not None else None
+        f = None
+        if static is None:
+            try:
+                f = open(fs_path, 'rb')
+                fs = os.fstat(f.fileno())
+            except IOError:
+                return self.send_error(404, "File not found",
+                    "No file found for given url")
+            ctype = _guess_type(fs_path)
+            if ctype.startswith("text/"):
+                ctype += ";charset=utf-8"
+            static = StaticFile(fs_path, fs, ctype,
+                email.utils.formatdate(fs.st_mtime, usegmt=True))
+            if cache is not None and cache.add(static, f):
+                f.close()
+                f = None
+        headers = self.response.headers
+
         # Use browser cache if possible
-        if "If-Modified-Since" in self.request.headers:
+        if self.not_modified(static.etag, static.mtime):
+            if f is not None:
+                f.close()
+            headers["ETag"] = static.etag
+            return self.done(304)
+
+        for key, value in static.headers:
+            del headers[key]
+            headers[key] = value
+        if f is None:
+            # the content is in the static files cache
+            f = MemoryFile(static.data)
+
+        if (application.compression is not None
+                and "Range" not in self.request.headers
+                and self.send_compressed(static, f)):
+            return
+
+        # Partial content
+        ranges = None
+        if self.request.method == "GET" and "Range" in self.request.headers:
+            # If-Range : only send the ranges if the file has not changed
+            if_range = self.request.headers["If-Range"]
+            if if_range is None or if_range.strip() in [static.last_modified,
+                    static.etag]:
+                ranges = _parse_ranges(self.request.headers["Range"],
+                    static.size)
+        if ranges == []:
+            f.close()
+            del headers["Content-Length"]
+            headers["Content-Range"] = "bytes */{}".format(static.size)
+            return self.send_error(416, "Range Not Satisfiable",
+                "Invalid range for a file of size {}".format(static.size))
+        elif ranges and len(ranges) == 1:
+            first, last = ranges[0]
+            headers["Content-Range"] = "bytes {}-{}/{}".format(first, last,
+                static.size)
+            headers.replace_header("Content-Length", str(last - first + 1))
+            return self.done(206, FileBody(f, first, last - first + 1))
+        elif ranges:
+            body = MultipartRangesBody(f, ranges, static.ctype, static.size)
+            # the parameters of the file type (charset...) are sent in each
+            # part
+            del headers["Content-Type"]
+            headers["Content-Type"] = ("multipart/byteranges; "
+                "boundary={}".format(body.boundary))
+            headers.replace_header("Content-Length", str(body.length))
+            return self.done(206, body)
+
+        if isinstance(static.data, bytes):
+            return self.done(200, static.data)
+        self.done(200, FileBody(f, 0, static.size))
+
+    def send_compressed(self, static, f):
+        """Send the static file compressed, if application.compression
+        allows it : return True if the response is sent."""
+        compression = application.compression
+        if not compression.compressible(static.ctype):
+            return False
+        headers = self.response.headers
+        _add_vary(headers, "Accept-Encoding")
+        encoding = compression.negotiate(
+            self.request.headers["Accept-Encoding"])
+        if (encoding is None or static.size < compression.min_size
+                or self.request.method == "HEAD"):
+            return False
+        if encoding == "gzip":
+            # precompressed file
+            path = static.path + ".gz"
+            index = application.static_index
+            if index is None or path in index:
+                try:
+                    gz = open(path, "rb")
+                except OSError:
+                    gz = None
+                if gz is not None:
+                    fs = os.fstat(gz.fileno())
+                    if fs.st_mtime_ns >= static.mtime_ns:
+                        f.close()
+                        del headers["Accept-Ranges"]
+                        headers.replace_header("Content-Length",
+                            str(fs.st_size))
+                        headers["Content-Encoding"] = "gzip"
+                        _weak_etag(headers)
+                        self.done(200, FileBody(gz, 0, fs.st_size))
+                        return True
+                    gz.close()
+        if static.size > compression.max_file_size:
+            return False
+        data = compression.static(static, f, encoding)
+        f.close()
+        del headers["Accept-Ranges"]
+        headers.replace_header("Content-Length", str(len(data)))
+        headers["Content-Encoding"] = encoding
+        _weak_etag(headers)
+        self.done(200, data)
+        return True
+
+    def not_modified(self, etag, mtime):
+        """Return True if the version of the resource in the browser cache is
+        still valid, based on the headers If-None-Match and If-Modified-Since.
+        etag is the ETag of the resource, mtime the timestamp of its last
+        modification ; each one can be None."""
+        if "If-None-Match" in self.request.headers:
+            if etag is None:
+                return False
+            etags = [value.strip() for value in
+                self.request.headers["If-None-Match"].split(",")]
+            return "*" in etags or etag in etags or "W/" + etag in etags
+        if mtime is not None and "If-Modified-Since" in self.request.headers:
             # compare If-Modified-Since and time of last file modification
             try:
                 ims = email.utils.parsedate_to_datetime(
                     self.request.headers["If-Modified-Since"])
             except (TypeError, IndexError, OverflowError, ValueError):
                 # ignore ill-formed values
-                pass
-            else:
-                if ims.tzinfo is None:
-                    # obsolete format with no timezone, cf.
-                    # https://tools.ietf.org/html/rfc7231#section-7.1.1.1
-                    ims = ims.replace(tzinfo=datetime.timezone.utc)
-                if ims.tzinfo is datetime.timezone.utc:
-                    # compare to UTC datetime of last modification
-                    last_modif = datetime.datetime.fromtimestamp(
-                        fs.st_mtime, datetime.timezone.utc)
-                    # remove microseconds, like in If-Modified-Since
-                    last_modif = last_modif.replace(microsecond=0)
-
-                    if last_modif <= ims:
-                        f.close()
-                        return self.done(304, io.BytesIO())
-        ctype = self.guess_type(fs_path)
-        if ctype.startswith("text/"):
-            ctype += ";charset=utf-8"
-        self.response.headers.set_type(ctype)
-        self.response.headers["Last-Modified"] = self.date_time_string(fs.st_mtime)
-        self.response.headers["Content-Length"] = str(os.fstat(f.fileno())[6])
-        self.done(200, f)
+                return False
+            if ims.tzinfo is None:
+                # obsolete format with no timezone, cf.
+                # https://tools.ietf.org/html/rfc7231#section-7.1.1.1
+                ims = ims.replace(tzinfo=datetime.timezone.utc)
+            if ims.tzinfo is datetime.timezone.utc:
+                # compare to UTC datetime of last modification
+                last_modif = datetime.datetime.fromtimestamp(
+                    mtime, datetime.timezone.utc)
+                # remove microseconds, like in If-Modified-Since
+                last_modif = last_modif.replace(microsecond=0)
+                return last_modif <= ims
+        return False
+
+    def cached_template(self, filename, keys=(), ttl=None, **kw):
+        """Same as template(), but the result is kept in
+        application.fragment_cache for ttl seconds, for each combination of
+        the values of the arguments named in keys.
+        """
+        cache = application.fragment_cache
+        if cache is None:
+            return self.template(filename, **kw)
+        key = cache.key(os.path.normpath(os.path.join(application.root,
+            "templates", filename)), keys, kw)
+        result = cache.get(key)
+        if result is None:
+            result = self.template(filename, **kw)
+            ctype = self.response.headers.get("Content-Type") or ""
+            if ctype.split(";")[0] == "text/html":
+                # not an error message
+                cache.set(key, result, ttl)
+        else:
+            self.response.headers.set_type("text/html")
+        return result
+
+    @classmethod
+    def invalidate_fragments(cls, filename=None, **values):
+        """Remove the output of template filename from
+        application.fragment_cache, for the specified values of its key
+        arguments, or for all values. If filename is None, remove all the
+        cached output."""
+        if filename is None:
+            cls.fragment_cache.clear()
+        else:
+            cls.fragment_cache.invalidate(os.path.normpath(os.path.join(
+                cls.root, "templates", filename)), **values)
 
     def template(self, filename, **kw):
         """If the template engine patrom is installed, use it to render the
-        template file with the specified key/values.
+        template file with the specified key/values. The compiled templates
+        are kept in application.template_cache.
         """
         from patrom import TemplateParser, TemplateError
-        parser = TemplateParser()
         path = os.path.join(application.root, "templates", filename)
+        cache = application.template_cache
         try:
-            result = parser.render(path, **kw)
+            if cache is None:
+                result = TemplateParser().render(path, **kw)
+            else:
+                result = cache.render(path, **kw)
             self.response.headers.set_type("text/html")
         except TemplateError as exc:
             result = str(exc)
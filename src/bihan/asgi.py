@@ -0,0 +1,303 @@
+"""ASGI entry point.
+
+The application is served by an ASGI server (uvicorn, hypercorn...) with
+an instance of ASGIApplication :
+
+    from bihan.asgi import ASGIApplication
+
+    app = ASGIApplication(__name__)
+
+It uses the same routes as the WSGI application. Functions and methods
+defined with "async def" are run in the event loop ; other functions, and
+static files, are handled in a pool of worker threads, so that they don't
+block the event loop.
+
+WebSocket connections are served by the methods "websocket" of the
+registered classes ; in coroutines, the methods of dialog.websocket are
+also coroutines.
+"""
+
+import asyncio
+import concurrent.futures
+import inspect
+import io
+import sys
+import traceback
+
+from . import application, Dialog
+
+
+class AsyncWebSocket:
+    """WebSocket connection used by coroutines."""
+
+    def __init__(self, receive, send):
+        self._receive = receive
+        self._send = send
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        message = await self.receive()
+        if message is None:
+            raise StopAsyncIteration
+        return message
+
+    async def close(self, code=1000):
+        if not self.closed:
+            self.closed = True
+            await self._send({"type": "websocket.close", "code": code})
+
+    async def receive(self):
+        """Return the next message, or None if the connection is closed."""
+        if self.closed:
+            return None
+        message = await self._receive()
+        if message["type"] == "websocket.disconnect":
+            self.closed = True
+            return None
+        if message.get("text") is not None:
+            return message["text"]
+        return message.get("bytes") or b""
+
+    async def send(self, message):
+        if isinstance(message, str):
+            await self._send({"type": "websocket.send", "text": message})
+        else:
+            await self._send({"type": "websocket.send",
+                "bytes": bytes(message)})
+
+
+class ThreadWebSocket:
+    """WebSocket connection used by functions run in worker threads : the
+    methods of an AsyncWebSocket are run in the event loop."""
+
+    def __init__(self, websocket, loop):
+        self.websocket = websocket
+        self.loop = loop
+
+    def __iter__(self):
+        while True:
+            message = self.receive()
+            if message is None:
+                break
+            yield message
+
+    def run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def close(self, code=1000):
+        self.run(self.websocket.close(code))
+
+    def receive(self):
+        return self.run(self.websocket.receive())
+
+    def send(self, message):
+        self.run(self.websocket.send(message))
+
+
+class ASGIApplication:
+    """ASGI callable. main is the name of the module whose namespace holds
+    the registered modules (by default, the main module). workers is the
+    maximum number of worker threads."""
+
+    def __init__(self, main=None, workers=None):
+        if main is not None:
+            application.main = main
+            application.registered = []
+        self.workers = workers
+        # created on first use, in the process that serves the requests
+        self.executor = None
+        self.routes_loaded = False
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+        elif scope["type"] == "websocket":
+            return await self.websocket(scope, receive, send)
+        elif scope["type"] != "http":
+            raise ValueError("unsupported scope type {}".format(
+                scope["type"]))
+        self.load_routes()
+        loop = asyncio.get_running_loop()
+
+        # read the request body
+        body = bytearray()
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+
+        response = []
+        def start_response(status, headers):
+            response[:] = [status, headers]
+
+        app = application(self.environ(scope, bytes(body)), start_response)
+        app.deferred = True
+        app.prepared = True
+        try:
+            kind, arg = app.resolve(scope["method"].lower(),
+                app.env["PATH_INFO"])
+            if kind == "func" and inspect.iscoroutinefunction(arg[0]):
+                app.process()
+            else:
+                await loop.run_in_executor(self.executor, app.process)
+            if app.pending is not None:
+                # result of an async function
+                try:
+                    result = await app.pending
+                except Exception:
+                    app.send_traceback()
+                else:
+                    app.send_result(result)
+                if app.cache_key is not None:
+                    app.cache_response()
+            app.start()
+
+            status, headers = response
+            await send({
+                "type": "http.response.start",
+                "status": int(status.split()[0]),
+                "headers": [(key.encode("latin-1"), value.encode("latin-1"))
+                    for key, value in headers]
+            })
+            body = app.response.body
+            if not isinstance(body, bytes):
+                # stop sending the body if the client disconnects
+                disconnect = asyncio.ensure_future(receive())
+                try:
+                    async for chunk in self.iter_body(body):
+                        if (disconnect.done() and disconnect.result()["type"]
+                                == "http.disconnect"):
+                            return
+                        await send({"type": "http.response.body",
+                            "body": chunk, "more_body": True})
+                finally:
+                    disconnect.cancel()
+                body = b""
+            await send({"type": "http.response.body", "body": body})
+        finally:
+            app.close()
+
+    async def iter_body(self, body):
+        """Iterate on a response body that is not a bytes object."""
+        if getattr(body, "asynchronous", False):
+            # event stream with an asynchronous iterator
+            async for chunk in body:
+                yield chunk
+            return
+        # files and iterators are read in worker threads
+        loop = asyncio.get_running_loop()
+        chunks = iter(body)
+        while True:
+            chunk = await loop.run_in_executor(self.executor, next, chunks,
+                None)
+            if chunk is None:
+                break
+            yield chunk
+
+    async def websocket(self, scope, receive, send):
+        """Serve a WebSocket connection with the method "websocket" mapped
+        to its url."""
+        self.load_routes()
+        loop = asyncio.get_running_loop()
+        message = await receive()
+        if message["type"] != "websocket.connect":
+            return
+        app = application(self.environ(dict(scope, method="GET"), b""),
+            None)
+        kind, arg = app.resolve("websocket", app.env["PATH_INFO"])
+        if kind != "func":
+            # closing before accepting : the server rejects the handshake
+            await send({"type": "websocket.close", "code": 1000})
+            return
+        func, kw = arg
+        app.request.url_fields = kw
+        await send({"type": "websocket.accept"})
+        websocket = AsyncWebSocket(receive, send)
+        try:
+            if inspect.iscoroutinefunction(func):
+                app.websocket = websocket
+                await func(Dialog(app))
+            else:
+                app.websocket = ThreadWebSocket(websocket, loop)
+                await loop.run_in_executor(self.executor, func, Dialog(app))
+        except Exception:
+            traceback.print_exc()
+            await websocket.close(1011)
+        finally:
+            await websocket.close()
+
+    def environ(self, scope, body):
+        """Return the WSGI environment for the request described by scope.
+        """
+        server = scope.get("server") or ("localhost", 80)
+        client = scope.get("client") or ("", 0)
+        environ = {
+            "REQUEST_METHOD": scope["method"],
+            "SCRIPT_NAME": scope.get("root_path", ""),
+            # same convention as WSGI : bytes decoded as latin-1
+            "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+            "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+            "SERVER_PROTOCOL": "HTTP/" + scope.get("http_version", "1.1"),
+            "SERVER_NAME": server[0],
+            "SERVER_PORT": str(server[1]),
+            "REMOTE_ADDR": client[0],
+            "REMOTE_PORT": str(client[1]),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": scope.get("scheme", "http"),
+            "CONTENT_LENGTH": str(len(body)),
+            "wsgi.input": io.BytesIO(body),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+            "asgi.scope": scope
+        }
+        for name, value in scope.get("headers", []):
+            name = name.decode("latin-1").upper().replace("-", "_")
+            value = value.decode("latin-1")
+            if name == "CONTENT_TYPE":
+                environ[name] = value
+                continue
+            elif name in ["CONTENT_LENGTH", "TRANSFER_ENCODING"]:
+                # the body is read by the server
+                continue
+            key = "HTTP_" + name
+            if key in environ:
+                # repeated header
+                value = environ[key] + "," + value
+            environ[key] = value
+        return environ
+
+    def load_routes(self):
+        """Load the routes on the first request."""
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                self.workers)
+        if not self.routes_loaded:
+            application.load_routes()
+            self.routes_loaded = True
+
+    async def lifespan(self, receive, send):
+        """Handle the startup and shutdown events sent by the server."""
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                try:
+                    self.load_routes()
+                except Exception as exc:
+                    await send({"type": "lifespan.startup.failed",
+                        "message": str(exc)})
+                    return
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if self.executor is not None:
+                    self.executor.shutdown(wait=False)
+                    self.executor = None
+                await send({"type": "lifespan.shutdown.complete"})
+                return
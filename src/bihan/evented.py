@@ -0,0 +1,342 @@
+"""Event-loop server engine for application.run(server="evented").
+
+A single thread accepts connections and reads requests with non-blocking
+sockets, multiplexed by the selectors module. When the head of a request
+(and its body, if it is small) is received, the request is handed to a
+pool of worker threads that run the WSGI application and send the response.
+The connection then goes back to the event loop, so that idle persistent
+connections don't occupy a thread.
+"""
+
+import concurrent.futures
+import io
+import queue
+import selectors
+import socket
+import threading
+import time
+
+from .server import (WSGIServer, KeepAliveRequestHandler,
+    KeepAliveServerHandler, RequestBody)
+
+
+class Connection:
+    """A client connection handled by the event loop."""
+
+    def __init__(self, sock, client_address):
+        self.sock = sock
+        self.client_address = client_address
+        self.buffer = bytearray() # received data not parsed yet
+        self.request = None # request waiting for its body
+        self.nb_requests = 0
+        self.last_activity = time.monotonic()
+
+
+class ConnectionReader:
+    """File-like object used by a worker thread to read a request body :
+    the data already received by the event loop, then the socket."""
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def read(self, size):
+        buffer = self.connection.buffer
+        while len(buffer) < size:
+            data = self.connection.sock.recv(size - len(buffer))
+            if not data:
+                break
+            buffer += data
+        data = bytes(buffer[:size])
+        del buffer[:size]
+        return data
+
+    def readline(self, size):
+        buffer = self.connection.buffer
+        while b"\n" not in buffer and len(buffer) < size:
+            data = self.connection.sock.recv(size - len(buffer))
+            if not data:
+                break
+            buffer += data
+        pos = buffer.find(b"\n", 0, size)
+        end = size if pos == -1 else pos + 1
+        line = bytes(buffer[:end])
+        del buffer[:end]
+        return line
+
+
+class EventedRequestHandler(KeepAliveRequestHandler):
+    """Parses the head of a request received by the event loop, and provides
+    the methods used to build the WSGI environment and log the request.
+    Responses to invalid requests are written in self.wfile."""
+
+    def __init__(self, server, connection, head):
+        self.server = server
+        self.client_address = connection.client_address
+        self.connection = connection.sock
+        self.rfile = io.BytesIO(head)
+        self.wfile = io.BytesIO()
+        self.raw_requestline = self.rfile.readline(65537)
+        self.close_connection = True
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            self.valid = False
+        else:
+            self.valid = self.parse_request()
+
+
+class EventedWSGIServer(WSGIServer):
+    """Server that reads requests in an event loop, and handles them in a
+    pool of worker threads. Connections are persistent (HTTP/1.1)."""
+
+    multithread = True
+    max_requests = None
+
+    # requests whose body is at most this size are read by the event loop
+    # before they are handed to a worker ; larger bodies are read by the
+    # worker
+    body_buffer_size = 1 << 16
+    # maximum size of the request line and headers
+    max_head_size = 1 << 17
+
+    def __init__(self, server_address, RequestHandlerClass, workers=None,
+            backlog=None, reuse_port=False):
+        super().__init__(server_address, RequestHandlerClass, backlog,
+            reuse_port)
+        self.socket.setblocking(False)
+        self.workers = workers or 8
+        # the event loop objects are created by serve_forever(), in the
+        # process that serves the requests (see serve_prefork)
+        self.pool = self.selector = None
+        self.connections = {} # connections handled by the event loop
+        self.nb_busy = 0 # connections handled by workers
+        self.done = queue.Queue() # connections sent back by workers
+        self.stopping = False
+        self.stopped = threading.Event()
+        self.next_idle_check = 0
+
+    def serve_forever(self, poll_interval=0.5):
+        """Run the event loop until shutdown() is called."""
+        if self.selector is None:
+            self.pool = concurrent.futures.ThreadPoolExecutor(self.workers)
+            self.selector = selectors.DefaultSelector()
+            self.wakeup_recv, self.wakeup_send = socket.socketpair()
+            self.wakeup_recv.setblocking(False)
+        self.stopped.clear()
+        self.selector.register(self.socket, selectors.EVENT_READ, None)
+        self.selector.register(self.wakeup_recv, selectors.EVENT_READ,
+            "wakeup")
+        try:
+            while not self.stopping:
+                for key, mask in self.selector.select(poll_interval):
+                    if key.data is None:
+                        self.accept()
+                    elif key.data == "wakeup":
+                        self.resume()
+                    else:
+                        self.receive(key.data)
+                self.close_idle()
+                if (self.max_requests is not None
+                        and self.nb_requests >= self.max_requests
+                        and self.finished()):
+                    break
+        finally:
+            if self.socket in self.selector.get_map():
+                self.selector.unregister(self.socket)
+            self.selector.unregister(self.wakeup_recv)
+            self.stopping = False
+            self.stopped.set()
+
+    def shutdown(self):
+        self.stopping = True
+        if self.selector is None:
+            # serve_forever() was not called
+            return
+        self.wakeup_send.send(b"\0")
+        self.stopped.wait()
+
+    def server_close(self):
+        if self.selector is not None:
+            self.pool.shutdown(wait=True)
+            for connection in list(self.connections.values()):
+                self.close(connection)
+            self.selector.close()
+            self.wakeup_recv.close()
+            self.wakeup_send.close()
+        super().server_close()
+
+    def accept(self):
+        """Accept the pending connections."""
+        while True:
+            if (self.max_requests is not None
+                    and self.nb_requests >= self.max_requests):
+                # stop accepting connections
+                self.selector.unregister(self.socket)
+                return
+            try:
+                sock, client_address = self.socket.accept()
+            except OSError:
+                # including BlockingIOError : no pending connection
+                return
+            self.nb_requests += 1
+            sock.setblocking(False)
+            connection = Connection(sock, client_address)
+            self.connections[sock] = connection
+            self.selector.register(sock, selectors.EVENT_READ, connection)
+
+    def close(self, connection):
+        """Close a connection handled by the event loop."""
+        if self.connections.pop(connection.sock, None) is not None:
+            self.selector.unregister(connection.sock)
+        try:
+            connection.sock.close()
+        except OSError:
+            pass
+
+    def close_idle(self):
+        """Close the connections idle for more than keep_alive_timeout. The
+        check is done at most once per second."""
+        now = time.monotonic()
+        if now < self.next_idle_check:
+            return
+        self.next_idle_check = now + 1
+        limit = now - self.keep_alive_timeout
+        for connection in list(self.connections.values()):
+            if connection.last_activity < limit:
+                self.close(connection)
+
+    def finished(self):
+        """Return True if no request is being received or handled."""
+        return not self.nb_busy and all(connection.nb_requests
+            and not connection.buffer and connection.request is None
+            for connection in self.connections.values())
+
+    def receive(self, connection):
+        """Read data sent on a connection."""
+        try:
+            data = connection.sock.recv(1 << 16)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self.close(connection)
+            return
+        connection.buffer += data
+        connection.last_activity = time.monotonic()
+        self.parse(connection)
+
+    def parse(self, connection):
+        """If a complete request was received on the connection, hand it to
+        a worker thread."""
+        buffer = connection.buffer
+        if connection.request is None:
+            end = buffer.find(b"\r\n\r\n")
+            if end == -1:
+                if len(buffer) > self.max_head_size:
+                    self.send(connection, b"HTTP/1.1 431 Request Header "
+                        b"Fields Too Large\r\nConnection: close\r\n\r\n")
+                    self.close(connection)
+                return
+            head = bytes(buffer[:end + 4])
+            del buffer[:end + 4]
+            request = EventedRequestHandler(self, connection, head)
+            # error responses, or "100 Continue"
+            self.send(connection, request.wfile.getvalue())
+            if not request.valid:
+                self.close(connection)
+                return
+            connection.request = request
+        request = connection.request
+        if "Transfer-Encoding" in request.headers:
+            length = None
+        else:
+            try:
+                length = int(request.headers.get("Content-Length") or 0)
+            except ValueError:
+                self.send(connection, b"HTTP/1.1 400 Bad Content-Length\r\n"
+                    b"Connection: close\r\n\r\n")
+                self.close(connection)
+                return
+            if len(buffer) < length <= self.body_buffer_size:
+                # wait for the rest of the body
+                return
+        connection.request = None
+        connection.nb_requests += 1
+        del self.connections[connection.sock]
+        self.selector.unregister(connection.sock)
+        self.nb_busy += 1
+        self.pool.submit(self.process, connection, request, length)
+
+    def process(self, connection, request, length):
+        """Run the application for a request, in a worker thread."""
+        keep_alive = False
+        sock = connection.sock
+        try:
+            # blocking reads, limited like those of the keep-alive handler ;
+            # files are sent with socket.sendfile() on request.connection,
+            # which waits until the socket is writable
+            sock.settimeout(self.request_timeout)
+            reader = ConnectionReader(connection)
+            if length is None:
+                # chunked request body, read by the application
+                stdin, body = reader, None
+            else:
+                keep_alive = not request.close_connection
+                stdin = body = RequestBody(reader, length)
+            if (self.keep_alive_requests is not None
+                    and connection.nb_requests >= self.keep_alive_requests):
+                keep_alive = False
+            with sock.makefile("wb") as stdout:
+                handler = KeepAliveServerHandler(stdin, stdout,
+                    request.get_stderr(), request.get_environ(),
+                    multithread=True, multiprocess=self.multiprocess)
+                handler.request_handler = request # backpointer for logging
+                handler.keep_alive = keep_alive
+                handler.connection_input = reader
+                handler.run(self.get_app())
+            keep_alive = (handler.keep_alive
+                and body.drain(request.drain_limit))
+            sock.setblocking(False)
+        except (socket.timeout, ConnectionError):
+            keep_alive = False
+        except Exception:
+            keep_alive = False
+            self.handle_error(sock, connection.client_address)
+        finally:
+            self.done.put((connection, keep_alive))
+            self.wakeup_send.send(b"\0")
+
+    def resume(self):
+        """Handle the connections sent back by the worker threads."""
+        try:
+            while self.wakeup_recv.recv(1024):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        while True:
+            try:
+                connection, keep_alive = self.done.get_nowait()
+            except queue.Empty:
+                break
+            self.nb_busy -= 1
+            self.connections[connection.sock] = connection
+            self.selector.register(connection.sock, selectors.EVENT_READ,
+                connection)
+            if not keep_alive or self.stopping:
+                self.close(connection)
+                continue
+            connection.last_activity = time.monotonic()
+            if connection.buffer:
+                # pipelined request
+                self.parse(connection)
+
+    def send(self, connection, data):
+        """Send a short response from the event loop."""
+        if data:
+            try:
+                connection.sock.send(data)
+            except OSError:
+                pass
@@ -0,0 +1,250 @@
+"""Parser for multipart/form-data request bodies.
+
+The body is read by large blocks, and the boundaries between parts are
+searched with bytes.find() in the buffer, instead of reading the body line
+by line. The content of each part is produced by chunks, so that it can be
+sent to its destination without being held in memory.
+"""
+
+import io
+import tempfile
+
+from .old_cgi import parse_header
+
+
+class MultipartError(ValueError):
+    """Raised for a malformed body, or if one of the limits is exceeded."""
+
+
+class Part:
+    """A field or a file in a multipart/form-data body.
+
+    The content is in the file object self.file ; it is kept in memory if
+    its size is at most the parser's spool_size, otherwise it is written
+    in a temporary file.
+    """
+
+    def __init__(self, name, filename, headers, file, size):
+        self.name = name
+        self.filename = filename
+        self.headers = headers
+        self.file = file
+        self.size = size
+
+    @property
+    def type(self):
+        return parse_header(self.headers.get("Content-Type") or
+            "text/plain")[0]
+
+    @property
+    def value(self):
+        """Content of the part : a string for fields, bytes for files."""
+        self.file.seek(0)
+        data = self.file.read()
+        self.file.seek(0)
+        if self.filename is not None:
+            return data
+        charset = parse_header(self.headers.get("Content-Type") or
+            "")[1].get("charset", "utf-8")
+        return data.decode(charset, "replace")
+
+
+class StreamPart:
+    """A part whose content is read from the request body while it is
+    iterated. Iterating on the part yields the chunks of its content ; it
+    can only be done once, before moving to the next part."""
+
+    def __init__(self, parser, name, filename, headers):
+        self.parser = parser
+        self.name = name
+        self.filename = filename
+        self.headers = headers
+        self.consumed = False
+
+    def __iter__(self):
+        if self.consumed:
+            raise MultipartError("content of part {} already read".format(
+                self.name))
+        self.consumed = True
+        return self.parser.read_content()
+
+    @property
+    def type(self):
+        return Part.type.fget(self)
+
+    def read(self):
+        """Return the whole content."""
+        return b"".join(self)
+
+    def save(self, fobj):
+        """Write the content in the file object fobj ; return its size."""
+        size = 0
+        for chunk in self:
+            fobj.write(chunk)
+            size += len(chunk)
+        return size
+
+
+class MultipartParser:
+    """Iterate on the parts of a multipart/form-data body read from fp.
+
+    boundary is the boundary parameter of the Content-Type header, length
+    the size of the body (None if it is read until the end of fp).
+
+    Parsing stops with MultipartError if there are more than max_parts
+    parts, or if the headers of a part are larger than max_header_size.
+    """
+
+    block_size = 1 << 16
+    spool_size = 1 << 20
+    max_parts = 1000
+    max_header_size = 1 << 14
+
+    def __init__(self, fp, boundary, length=None, **kw):
+        for key, value in kw.items():
+            if not hasattr(self, key):
+                raise TypeError("unexpected argument {}".format(key))
+            setattr(self, key, value)
+        if isinstance(boundary, str):
+            boundary = boundary.encode("latin-1")
+        if not boundary or len(boundary) > 200:
+            raise MultipartError("invalid boundary")
+        self.fp = fp
+        self.remaining = length
+        # the delimiter of each part is "\r\n--boundary" : the body is
+        # parsed as if it started with "\r\n"
+        self.delimiter = b"\r\n--" + boundary
+        self.buffer = bytearray(b"\r\n")
+        self.eof = False
+        # True until the delimiter at the end of the current part is read
+        self.in_part = False
+
+    def __iter__(self):
+        """Yield StreamPart objects."""
+        buffer = self.buffer
+        delimiter = self.delimiter
+        # skip the preamble
+        pos = self._find(delimiter, 0)
+        del buffer[:pos + len(delimiter)]
+        nb_parts = 0
+        while True:
+            # after a delimiter : "--" at the end of the body, or "\r\n"
+            while len(buffer) < 2 and self._fill():
+                pass
+            if buffer[:2] == b"--":
+                return
+            elif buffer[:2] != b"\r\n":
+                raise MultipartError("invalid delimiter")
+            nb_parts += 1
+            if nb_parts > self.max_parts:
+                raise MultipartError("more than {} parts".format(
+                    self.max_parts))
+            end = self._find(b"\r\n\r\n", 0, self.max_header_size)
+            if end > self.max_header_size:
+                raise MultipartError("part headers larger than {} bytes"
+                    .format(self.max_header_size))
+            head = bytes(buffer[2:end])
+            del buffer[:end + 4]
+            name, filename, headers = self._parse_headers(head)
+            part = StreamPart(self, name, filename, headers)
+            self.in_part = True
+            yield part
+            if self.in_part:
+                # skip the content that was not read, including the rest of
+                # a part whose iteration was stopped
+                for chunk in self.read_content():
+                    pass
+
+    def _fill(self):
+        """Read a block from fp into the buffer. Return False at the end of
+        the body."""
+        if self.eof:
+            return False
+        size = self.block_size
+        if self.remaining is not None:
+            size = min(size, self.remaining)
+        data = self.fp.read(size) if size else b""
+        if not data:
+            self.eof = True
+            return False
+        if self.remaining is not None:
+            self.remaining -= len(data)
+        self.buffer += data
+        return True
+
+    def _find(self, sub, start, limit=None):
+        """Return the position of sub in the buffer, reading the body until
+        it is found."""
+        buffer = self.buffer
+        while True:
+            pos = buffer.find(sub, start)
+            if pos != -1:
+                return pos
+            if limit is not None and len(buffer) > limit:
+                raise MultipartError("part headers larger than {} bytes"
+                    .format(limit))
+            # sub may start in the last bytes of the buffer
+            start = max(0, len(buffer) - len(sub) + 1)
+            if not self._fill():
+                raise MultipartError("unexpected end of body")
+
+    def _parse_headers(self, head):
+        from . import Headers
+        headers = Headers()
+        for line in head.decode("utf-8", "replace").split("\r\n"):
+            name, sep, value = line.partition(":")
+            if not sep:
+                raise MultipartError("invalid part header")
+            headers[name.strip()] = value.strip()
+        disposition = headers.get("Content-Disposition")
+        if disposition is None:
+            raise MultipartError("missing Content-Disposition")
+        params = parse_header(disposition)[1]
+        if "name" not in params:
+            raise MultipartError("missing field name")
+        return params["name"], params.get("filename"), headers
+
+    def parts(self):
+        """Yield Part objects : the content of each part is stored in memory
+        or in a temporary file."""
+        for part in self:
+            chunks, size, file = [], 0, None
+            for chunk in part:
+                size += len(chunk)
+                if file is not None:
+                    file.write(chunk)
+                elif size > self.spool_size:
+                    file = tempfile.TemporaryFile()
+                    file.writelines(chunks)
+                    file.write(chunk)
+                    chunks = None
+                else:
+                    chunks.append(chunk)
+            if file is None:
+                file = io.BytesIO(b"".join(chunks))
+            file.seek(0)
+            yield Part(part.name, part.filename, part.headers, file, size)
+
+    def read_content(self):
+        """Yield the chunks of the content of the current part."""
+        buffer = self.buffer
+        delimiter = self.delimiter
+        keep = len(delimiter) - 1
+        start = 0
+        while True:
+            pos = buffer.find(delimiter, start)
+            if pos != -1:
+                chunk = bytes(buffer[:pos])
+                del buffer[:pos + len(delimiter)]
+                self.in_part = False
+                if chunk:
+                    yield chunk
+                return
+            # the end of the buffer may be the start of the delimiter
+            if len(buffer) > keep:
+                chunk = bytes(buffer[:len(buffer) - keep])
+                del buffer[:len(buffer) - keep]
+                yield chunk
+            start = 0
+            if not self._fill():
+                raise MultipartError("unexpected end of body")
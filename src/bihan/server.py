@@ -0,0 +1,721 @@
+"""Built-in HTTP server used by application.run()."""
+
+import base64
+import gc
+import hashlib
+import os
+import queue
+import signal
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+import traceback
+import wsgiref.simple_server
+
+
+class WebSocket:
+    """WebSocket connection (RFC 6455) whose opening handshake is complete.
+
+    receive() returns the next message sent by the client, a string for
+    text messages or bytes for binary messages, or None when the connection
+    is closed. send() sends a message. Messages can be sent from several
+    threads.
+    """
+
+    # maximum size of a message sent by the client
+    max_size = 1 << 20
+
+    def __init__(self, rfile, wfile):
+        self.rfile = rfile
+        self.wfile = wfile
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def __iter__(self):
+        while True:
+            message = self.receive()
+            if message is None:
+                break
+            yield message
+
+    def close(self, code=1000):
+        """Send a close frame, if it was not sent yet."""
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.send_frame(0x8, struct.pack("!H", code))
+        except OSError:
+            pass
+
+    def read(self, size):
+        data = b""
+        while len(data) < size:
+            block = self.rfile.read(size - len(data))
+            if not block:
+                raise ConnectionError("connection closed")
+            data += block
+        return data
+
+    def read_frame(self):
+        """Return the tuple (fin, opcode, payload) for the next frame."""
+        head = self.read(2)
+        fin, opcode = head[0] & 0x80, head[0] & 0x0f
+        length = head[1] & 0x7f
+        if length == 126:
+            length = struct.unpack("!H", self.read(2))[0]
+        elif length == 127:
+            length = struct.unpack("!Q", self.read(8))[0]
+        if length > self.max_size:
+            raise ValueError("message too big")
+        if not head[1] & 0x80:
+            # client frames must be masked
+            raise ValueError("frame not masked")
+        mask = self.read(4)
+        payload = self.read(length)
+        if length:
+            # unmask the payload in one operation on integers
+            mask = (mask * (length // 4 + 1))[:length]
+            payload = (int.from_bytes(payload, "big")
+                ^ int.from_bytes(mask, "big")).to_bytes(length, "big")
+        return fin, opcode, payload
+
+    def receive(self):
+        """Return the next message, or None if the connection is closed."""
+        if self.closed:
+            return None
+        parts, size, kind = [], 0, None
+        while True:
+            try:
+                fin, opcode, payload = self.read_frame()
+            except ValueError:
+                self.close(1009)
+                return None
+            except OSError:
+                self.closed = True
+                return None
+            if opcode == 0x8:
+                # close frame : answer with a close frame
+                self.close()
+                return None
+            elif opcode == 0x9:
+                # ping
+                self.send_frame(0xA, payload)
+                continue
+            elif opcode == 0xA:
+                # pong
+                continue
+            elif opcode in (0x1, 0x2):
+                parts, size, kind = [], 0, opcode
+            elif opcode != 0x0 or kind is None:
+                self.close(1002)
+                return None
+            parts.append(payload)
+            size += len(payload)
+            if size > self.max_size:
+                self.close(1009)
+                return None
+            if fin:
+                message = b"".join(parts)
+                if kind == 0x1:
+                    try:
+                        return message.decode("utf-8")
+                    except UnicodeDecodeError:
+                        self.close(1007)
+                        return None
+                return message
+
+    def send(self, message):
+        """Send a message : a text message if it is a string, a binary
+        message otherwise."""
+        if isinstance(message, str):
+            self.send_frame(0x1, message.encode("utf-8"))
+        else:
+            self.send_frame(0x2, bytes(message))
+
+    def send_frame(self, opcode, payload):
+        length = len(payload)
+        if length < 126:
+            head = struct.pack("!BB", 0x80 | opcode, length)
+        elif length < 1 << 16:
+            head = struct.pack("!BBH", 0x80 | opcode, 126, length)
+        else:
+            head = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+        with self.lock:
+            self.wfile.write(head + payload)
+            self.wfile.flush()
+
+
+def websocket_accept_key(key):
+    """Value of header Sec-WebSocket-Accept for the Sec-WebSocket-Key key."""
+    key += "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+    digest = hashlib.sha1(key.encode("ascii")).digest()
+    return base64.b64encode(digest).decode("ascii")
+
+
+class ServerHandler(wsgiref.simple_server.ServerHandler):
+    """Handler that sends the response bodies backed by a file (static files)
+    with os.sendfile(), so that their content is not read in Python memory.
+
+    It also lets the application take over the connection for WebSocket
+    requests : environ["bihan.websocket"] is a function that completes the
+    handshake and returns a WebSocket ; the response sent by the
+    application after that is ignored.
+    """
+
+    upgraded = False
+    # set by the request handler
+    request_handler = None
+    # file to read the connection from after the handshake, if the request
+    # body is read from another file
+    connection_input = None
+
+    def setup_environ(self):
+        super().setup_environ()
+        self.environ["bihan.websocket"] = self.accept_websocket
+
+    def accept_websocket(self):
+        """Send the response to a WebSocket opening handshake, and return
+        a WebSocket for the connection."""
+        key = self.environ["HTTP_SEC_WEBSOCKET_KEY"]
+        self._write(("HTTP/1.1 101 Switching Protocols\r\n"
+            "Upgrade: websocket\r\n"
+            "Connection: Upgrade\r\n"
+            "Sec-WebSocket-Accept: {}\r\n\r\n").format(
+                websocket_accept_key(key)).encode("latin-1"))
+        self._flush()
+        self.upgraded = True
+        # the connection can't be used for other requests
+        self.keep_alive = False
+        connection = getattr(self.request_handler, "connection", None)
+        if connection is not None:
+            # a WebSocket can stay idle
+            connection.settimeout(None)
+        rfile = self.connection_input
+        return WebSocket(rfile if rfile is not None else self.stdin,
+            self.stdout)
+
+    def finish_content(self):
+        if not self.upgraded:
+            super().finish_content()
+
+    def write(self, data):
+        if not self.upgraded:
+            super().write(data)
+
+    def result_is_file(self):
+        # bihan applications process the request when their result is first
+        # iterated : do it now to know if the response body is a file
+        prepare = getattr(self.result, "prepare", None)
+        if prepare is None:
+            return False
+        prepare()
+        return hasattr(self.result.response.body, "fileno")
+
+    def sendfile(self):
+        """Send the body with os.sendfile(), through socket.sendfile() if
+        the connection socket is known. Return False if it is not available,
+        the body is then sent by iterating on the result."""
+        if not hasattr(os, "sendfile"):
+            return False
+        body = self.result.response.body
+        try:
+            out_fd = self.stdout.fileno()
+            in_fd = body.fileno()
+        except (AttributeError, OSError):
+            return False
+        if not self.headers_sent:
+            self.send_headers()
+        self._flush()
+        connection = getattr(self.request_handler, "connection", None)
+        if connection is not None:
+            # a socket with a timeout is non-blocking : os.sendfile() would
+            # fail when its buffer is full, socket.sendfile() waits until it
+            # is writable
+            if body.length > 0:
+                self.bytes_sent += connection.sendfile(body.file,
+                    body.offset, body.length)
+            return True
+        offset, remaining = body.offset, body.length
+        while remaining > 0:
+            sent = os.sendfile(out_fd, in_fd, offset, remaining)
+            if sent == 0:
+                # file truncated since its size was read
+                break
+            offset += sent
+            remaining -= sent
+            self.bytes_sent += sent
+        return True
+
+
+class WSGIRequestHandler(wsgiref.simple_server.WSGIRequestHandler):
+    """Request handler that uses ServerHandler."""
+
+    def handle(self):
+        """Handle a single HTTP request"""
+        self.raw_requestline = self.rfile.readline(65537)
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            return
+
+        if not self.parse_request(): # An error code has been sent, just exit
+            return
+
+        handler = ServerHandler(self.rfile, self.wfile, self.get_stderr(),
+            self.get_environ(), multithread=self.server.multithread,
+            multiprocess=self.server.multiprocess)
+        handler.request_handler = self # backpointer for logging
+        handler.run(self.server.get_app())
+
+
+class RequestBody:
+    """wsgi.input for persistent connections : reads at most length bytes,
+    the size of the request body, so that the application can't read the
+    next request sent on the same connection."""
+
+    def __init__(self, rfile, length):
+        self.rfile = rfile
+        self.remaining = length
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                break
+            yield line
+
+    def drain(self, limit):
+        """Read the part of the body that the application didn't read. Return
+        False if it is longer than limit."""
+        if self.remaining > limit:
+            return False
+        while self.remaining:
+            if not self.read(1 << 16):
+                return False
+        return True
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.rfile.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        line = self.rfile.readline(size)
+        self.remaining -= len(line)
+        return line
+
+    def readlines(self, hint=-1):
+        return list(self)
+
+
+class KeepAliveServerHandler(ServerHandler):
+    """Handler for HTTP/1.1 persistent connections. The response body is
+    sent with chunked transfer encoding if its length is unknown.
+
+    keep_alive is set by the request handler if the connection can be kept
+    open after the response ; it is reset if the response can't be
+    delimited.
+    """
+
+    http_version = "1.1"
+    keep_alive = False
+    chunked = False
+
+    def cleanup_headers(self):
+        super().cleanup_headers()
+        status = int(self.status[:3])
+        has_body = (self.environ["REQUEST_METHOD"] != "HEAD"
+            and status >= 200 and status not in (204, 304))
+        http10 = self.environ.get("SERVER_PROTOCOL") == "HTTP/1.0"
+        if "Content-Length" not in self.headers and has_body:
+            if http10:
+                # the end of the body is the end of the connection
+                self.keep_alive = False
+            else:
+                self.headers["Transfer-Encoding"] = "chunked"
+                self.chunked = True
+        if (self.headers.get("Connection") or "").lower() == "close":
+            self.keep_alive = False
+        if not self.keep_alive:
+            self.headers["Connection"] = "close"
+        elif http10:
+            self.headers["Connection"] = "keep-alive"
+
+    def finish_content(self):
+        if self.upgraded:
+            return
+        elif self.chunked:
+            self._write(b"0\r\n\r\n")
+            self._flush()
+        else:
+            super().finish_content()
+
+    def handle_error(self):
+        # if headers are sent, the response can't be completed
+        self.keep_alive = False
+        super().handle_error()
+
+    def sendfile(self):
+        if self.environ["REQUEST_METHOD"] == "HEAD":
+            if not self.headers_sent:
+                self.send_headers()
+            return True
+        return super().sendfile()
+
+    def write(self, data):
+        if not self.status:
+            raise AssertionError("write() before start_response()")
+        if self.upgraded:
+            return
+        if not self.headers_sent:
+            # bytes_sent is used to set Content-Length if the response has a
+            # single block
+            self.bytes_sent = len(data)
+            self.send_headers()
+        else:
+            self.bytes_sent += len(data)
+        if not data or self.environ["REQUEST_METHOD"] == "HEAD":
+            return
+        if self.chunked:
+            self._write(b"%x\r\n" % len(data))
+            self._write(data)
+            self._write(b"\r\n")
+        else:
+            self._write(data)
+        self._flush()
+
+
+class KeepAliveRequestHandler(WSGIRequestHandler):
+    """Request handler that serves several requests on the same connection
+    (HTTP/1.1 persistent connections, including pipelined requests).
+
+    The connection is closed if the client asks for it, if it is idle for
+    more than server.keep_alive_timeout seconds, or after
+    server.keep_alive_requests requests. Once the request line is received,
+    each read of the request must complete within server.request_timeout
+    seconds.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    # maximum size of a request body not read by the application that is
+    # read to keep the connection open
+    drain_limit = 1 << 20
+
+    def handle(self):
+        """Handle the HTTP requests sent on the connection"""
+        nb_requests = 0
+        while True:
+            self.connection.settimeout(self.server.keep_alive_timeout)
+            try:
+                self.raw_requestline = self.rfile.readline(65537)
+            except (socket.timeout, ConnectionError):
+                return
+            if not self.raw_requestline:
+                # connection closed by the client
+                return
+            # the rest of the request must be received within
+            # server.request_timeout seconds
+            self.connection.settimeout(self.server.request_timeout)
+            if len(self.raw_requestline) > 65536:
+                self.requestline = ''
+                self.request_version = ''
+                self.command = ''
+                self.send_error(414)
+                return
+
+            try:
+                if not self.parse_request(): # An error code has been sent
+                    return
+            except (socket.timeout, ConnectionError):
+                return
+            nb_requests += 1
+
+            body = None
+            keep_alive = not self.close_connection
+            if "Transfer-Encoding" in self.headers:
+                # chunked request bodies are read by the application
+                stdin = self.rfile
+                keep_alive = False
+            else:
+                try:
+                    length = int(self.headers.get("Content-Length") or 0)
+                except ValueError:
+                    self.send_error(400, "Bad Content-Length")
+                    return
+                stdin = body = RequestBody(self.rfile, length)
+            if (self.server.keep_alive_requests is not None
+                    and nb_requests >= self.server.keep_alive_requests):
+                keep_alive = False
+
+            handler = KeepAliveServerHandler(stdin, self.wfile,
+                self.get_stderr(), self.get_environ(),
+                multithread=self.server.multithread,
+                multiprocess=self.server.multiprocess)
+            handler.request_handler = self # backpointer for logging
+            handler.keep_alive = keep_alive
+            handler.connection_input = self.rfile
+            handler.run(self.server.get_app())
+            if not handler.keep_alive:
+                return
+            try:
+                if not body.drain(self.drain_limit):
+                    return
+            except (socket.timeout, ConnectionError):
+                return
+
+
+class WSGIServer(wsgiref.simple_server.WSGIServer):
+    """Server that handles one request at a time. backlog is the size of the
+    queue of connections not yet accepted. If reuse_port is set, other
+    sockets can be bound to the same port (SO_REUSEPORT)."""
+
+    multithread = False
+    multiprocess = False
+    nb_requests = 0
+    keep_alive_timeout = 5
+    keep_alive_requests = 100
+    # timeout of the reads of a request on a persistent connection, after
+    # its request line
+    request_timeout = 60
+
+    def __init__(self, server_address, RequestHandlerClass, backlog=None,
+            reuse_port=False):
+        if backlog is not None:
+            self.request_queue_size = backlog
+        self.reuse_port = reuse_port
+        super().__init__(server_address, RequestHandlerClass)
+
+    def get_request(self):
+        request, client_address = super().get_request()
+        # in worker processes, the listening socket is non-blocking (see
+        # _serve_worker) : on some platforms (BSD, macOS), the accepted
+        # sockets inherit this flag
+        request.setblocking(True)
+        return request, client_address
+
+    def verify_request(self, request, client_address):
+        # called for each accepted connection
+        self.nb_requests += 1
+        return True
+
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+
+class ThreadingWSGIServer(socketserver.ThreadingMixIn, WSGIServer):
+    """Server that handles each request in a new thread."""
+
+    daemon_threads = True
+    multithread = True
+
+
+class ThreadPoolWSGIServer(WSGIServer):
+    """Server that handles requests in a pool of worker threads.
+
+    Accepted connections wait in a queue of at most queue_size connections
+    until a worker is available ; when the queue is full, the server stops
+    accepting new connections.
+
+    The worker threads are started when the first connection is accepted,
+    so that they are created in the process that serves the requests (see
+    serve_prefork).
+    """
+
+    multithread = True
+
+    def __init__(self, server_address, RequestHandlerClass, workers,
+            queue_size=None, backlog=None, reuse_port=False):
+        super().__init__(server_address, RequestHandlerClass, backlog,
+            reuse_port)
+        self.nb_workers = workers
+        self.requests = queue.Queue(queue_size or 4 * workers)
+        self.workers = []
+
+    def process_request(self, request, client_address):
+        if not self.workers:
+            for i in range(self.nb_workers):
+                worker = threading.Thread(target=self.work, daemon=True)
+                worker.start()
+                self.workers.append(worker)
+        self.requests.put((request, client_address))
+
+    def server_close(self):
+        super().server_close()
+        for worker in self.workers:
+            self.requests.put(None)
+        for worker in self.workers:
+            worker.join()
+
+    def work(self):
+        """Handle the requests put in the queue, until None is received."""
+        while True:
+            item = self.requests.get()
+            if item is None:
+                break
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+
+modes = [None, "threads"]
+
+servers = [None, "evented"]
+
+def make_server(host, port, app, mode=None, workers=None, backlog=None,
+        queue_size=None, reuse_port=False, keep_alive=False,
+        keep_alive_timeout=5, keep_alive_requests=100, server=None):
+    """Create a server for the WSGI application app.
+
+    If mode is None, the server handles one request at a time. If mode is
+    "threads", requests are handled in a pool of worker threads, or in a
+    new thread for each request if workers is None.
+
+    If keep_alive is set, connections are kept open after a response until
+    they have been idle for keep_alive_timeout seconds, or have served
+    keep_alive_requests requests.
+
+    If server is "evented", requests are read by an event loop and handled
+    in a pool of worker threads (8 if workers is None) ; connections are
+    always persistent, and mode is ignored.
+    """
+    if server not in servers:
+        raise ValueError("server must be one of {}".format(servers))
+    if mode not in modes:
+        raise ValueError("mode must be one of {}".format(modes))
+    handler_class = WSGIRequestHandler
+    if keep_alive:
+        handler_class = KeepAliveRequestHandler
+    if server == "evented":
+        from .evented import EventedWSGIServer
+        httpd = EventedWSGIServer((host, port), handler_class, workers,
+            backlog, reuse_port)
+    elif mode is None:
+        httpd = WSGIServer((host, port), handler_class, backlog, reuse_port)
+    elif workers is None:
+        httpd = ThreadingWSGIServer((host, port), handler_class, backlog,
+            reuse_port)
+    else:
+        httpd = ThreadPoolWSGIServer((host, port), handler_class, workers,
+            queue_size, backlog, reuse_port)
+    httpd.keep_alive_timeout = keep_alive_timeout
+    httpd.keep_alive_requests = keep_alive_requests
+    httpd.set_app(app)
+    return httpd
+
+
+def serve_prefork(httpd, processes, max_requests=None, freeze_gc=True,
+        init=None):
+    """Serve requests in processes worker processes forked from the current
+    one, which restarts a worker when it exits.
+
+    httpd is either a server, whose listening socket is shared by the
+    workers, or a function called in each worker to create its server
+    (with SO_REUSEPORT).
+
+    If max_requests is set, a worker exits after handling this number of
+    requests and is replaced by a new one. If freeze_gc is set, the objects
+    created before the workers are forked are moved out of the reach of
+    the garbage collector (gc.freeze), so that their memory pages remain
+    shared with the workers. init is a function called in each worker
+    before it starts serving requests.
+    """
+    if not hasattr(os, "fork"):
+        raise RuntimeError("processes are not supported on this platform")
+    if freeze_gc and hasattr(gc, "freeze"):
+        gc.collect()
+        gc.freeze()
+    workers = set()
+    stopping = False
+
+    def spawn():
+        pid = os.fork()
+        if pid:
+            workers.add(pid)
+            return
+        # worker process
+        status = 0
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            if init is not None:
+                init()
+            _serve_worker(httpd if not callable(httpd) else httpd(),
+                max_requests)
+        except KeyboardInterrupt:
+            pass
+        except BaseException:
+            traceback.print_exc()
+            status = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(status)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    for i in range(processes):
+        spawn()
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except KeyboardInterrupt:
+            stop(signal.SIGINT, None)
+            continue
+        workers.discard(pid)
+        if stopping:
+            continue
+        if os.WIFSIGNALED(status) or os.WEXITSTATUS(status):
+            print("worker {} died, restarting it".format(pid),
+                file=sys.stderr)
+            # don't restart workers too fast if they crash at startup
+            time.sleep(1)
+        spawn()
+
+
+def _serve_worker(httpd, max_requests):
+    """Serve requests in a worker process."""
+    httpd.multiprocess = True
+    if isinstance(httpd, socketserver.ThreadingMixIn):
+        # wait for the requests being handled before the worker exits
+        httpd.daemon_threads = False
+    # Workers compete to accept connections on the same socket : the ones
+    # that lose must not block in accept()
+    httpd.socket.setblocking(False)
+    try:
+        if max_requests is None:
+            httpd.serve_forever()
+        elif hasattr(httpd, "max_requests"):
+            # the event loop stops after max_requests connections
+            httpd.max_requests = max_requests
+            httpd.serve_forever()
+        else:
+            while httpd.nb_requests < max_requests:
+                httpd.handle_request()
+    finally:
+        httpd.server_close()
@@ -1,5 +1,7 @@
+import hashlib
 import json
 import mimetypes
+import time
 
 from scripts.utils import format_response
 
@@ -55,4 +57,84 @@ class trailing_slash:
     
     def get(self):
         return 'trailing slash'
-    get.url = '/trailing_slash/'
\ No newline at end of file
+    get.url = '/trailing_slash/'
+
+class stream:
+
+    def get(self):
+        return ('line {}\n'.format(i) for i in range(3))
+
+class send_file:
+
+    def get(self):
+        self.response.headers.set_type('text/plain')
+        return open(__file__, 'rb')
+
+class async_hello:
+
+    async def get(self):
+        return 'async ' + self.request.fields.get('name', 'hello')
+
+class echo:
+
+    def websocket(self):
+        for message in self.websocket:
+            self.websocket.send(message)
+
+class async_echo:
+
+    async def websocket(self):
+        async for message in self.websocket:
+            await self.websocket.send(message.upper())
+
+class events:
+
+    def get(self):
+        def ticks():
+            for i in range(2):
+                time.sleep(0.1)
+                yield {'event': 'tick', 'data': i}
+        return self.event_stream(ticks(), heartbeat=0.04)
+
+class upload_fields:
+
+    def post(self):
+        upload = self.request.fields['file']
+        return json.dumps({'name': self.request.fields['name'],
+            'filename': upload.filename, 'content': upload.value.decode()})
+
+class upload_stream:
+
+    def post(self):
+        result = {}
+        for part in self.request.parts:
+            digest = hashlib.sha1()
+            for chunk in part:
+                digest.update(chunk)
+            result[part.name] = [part.filename, digest.hexdigest()]
+        return json.dumps(result)
+    post.stream_parts = True
+
+class cached:
+
+    count = 0
+
+    def get(self):
+        cached.count += 1
+        return '{} {}'.format(self.request.fields.get('name', ''),
+            cached.count)
+    get.cache = 60
+
+class etag:
+
+    def get(self):
+        return 'etag'
+    get.etag = True
+
+class validated:
+
+    version = 1
+
+    def get(self):
+        return 'version {}'.format(validated.version)
+    get.etag = lambda dialog: 'v{}'.format(validated.version)
@@ -1,9 +1,20 @@
+import gzip
+import io
+import itertools
 import os
 import time
+import types
 import unittest
 import urllib.parse
 import urllib.request
+import urllib.error
 import json
+import signal
+import http.client
+import asyncio
+import socket
+import tempfile
+import zlib
 
 from wsgiref.simple_server import make_server
 
@@ -117,8 +128,761 @@ class Test(BaseTestCase):
         self.assertEqual(response.code, 302)
         self.assertEqual(response.headers['Location'], '/trailing_slash/')
 
+    def test_static_file(self):
+        req = request('/scripts/functions.py')
+        with open(os.path.join('scripts', 'functions.py'), 'rb') as f:
+            self.assertEqual(req.read(), f.read())
+        self.assertEqual(req.headers['Content-Length'],
+            str(os.path.getsize(os.path.join('scripts', 'functions.py'))))
+
+    def test_static_file_range(self):
+        with open(os.path.join('scripts', 'functions.py'), 'rb') as f:
+            content = f.read()
+        req = urllib.request.Request('http://localhost:8080/scripts/functions.py',
+            headers={'Range': 'bytes=5-14'})
+        response = urllib.request.urlopen(req)
+        self.assertEqual(response.code, 206)
+        self.assertEqual(response.read(), content[5:15])
+        self.assertEqual(response.headers['Content-Range'],
+            'bytes 5-14/{}'.format(len(content)))
+        # suffix range
+        req = urllib.request.Request('http://localhost:8080/scripts/functions.py',
+            headers={'Range': 'bytes=-10'})
+        self.assertEqual(urllib.request.urlopen(req).read(), content[-10:])
+        # several ranges
+        req = urllib.request.Request('http://localhost:8080/scripts/functions.py',
+            headers={'Range': 'bytes=0-1,10-12'})
+        response = urllib.request.urlopen(req)
+        # no parameters of the file type
+        self.assertEqual([name for name, value in
+            response.headers.get_params()],
+            ['multipart/byteranges', 'boundary'])
+        body = response.read()
+        self.assertIn(content[10:13], body)
+        self.assertEqual(len(body), int(response.headers['Content-Length']))
+
+    def test_static_file_range_not_satisfiable(self):
+        opener = urllib.request.build_opener(NoRedirection)
+        req = urllib.request.Request('http://localhost:8080/scripts/functions.py',
+            headers={'Range': 'bytes=100000-'})
+        response = opener.open(req)
+        self.assertEqual(response.code, 416)
+        # suffix range of an empty file
+        with tempfile.NamedTemporaryFile(dir=application.root,
+                suffix='.txt') as empty:
+            req = urllib.request.Request('http://localhost:8080/' +
+                os.path.basename(empty.name), headers={'Range': 'bytes=-10'})
+            response = opener.open(req)
+            self.assertEqual(response.code, 416)
+            self.assertEqual(response.headers['Content-Range'], 'bytes */0')
+
+    def test_static_cache(self):
+        application.static_cache = cache = StaticCache()
+        try:
+            for i in range(2):
+                req = request('/scripts/functions.py')
+                etag = req.headers['ETag']
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+            opener = urllib.request.build_opener(NoRedirection)
+            req = urllib.request.Request(
+                'http://localhost:8080/scripts/functions.py',
+                headers={'If-None-Match': etag})
+            self.assertEqual(opener.open(req).code, 304)
+        finally:
+            application.static_cache = None
+
+    def test_static_index(self):
+        application.static_index = StaticIndex(application.root)
+        try:
+            req = request('/scripts/functions.py')
+            self.assertEqual(req.code, 200)
+            opener = urllib.request.build_opener(NoRedirection)
+            response = opener.open('http://localhost:8080/wp-login.php')
+            self.assertEqual(response.code, 404)
+        finally:
+            application.static_index = None
+
+    def test_stream(self):
+        req = request('/stream')
+        self.assertEqual(req.read(), b'line 0\nline 1\nline 2\n')
+        self.assertIsNone(req.headers['Content-Length'])
+
+    def test_file_object(self):
+        req = request('/send_file')
+        with open(os.path.join('scripts', 'classes.py'), 'rb') as f:
+            self.assertEqual(req.read(), f.read())
+
+    def test_event_stream(self):
+        req = request('/events')
+        self.assertTrue(req.headers['Content-Type'].startswith(
+            'text/event-stream'))
+        self.assertEqual(req.headers['Cache-Control'], 'no-cache')
+        body = req.read()
+        self.assertIn(b'event: tick\ndata: 0\n\nevent: tick\ndata: 1\n\n',
+            body.replace(b':\n\n', b''))
+        # heartbeats are sent while waiting for the events
+        self.assertGreater(body.count(b':\n\n'), 2)
+
+    def test_response_cache(self):
+        first = request('/cached?name=a').read()
+        self.assertEqual(request('/cached?name=a').read(), first)
+        self.assertNotEqual(request('/cached?name=b').read(), first)
+        application.response_cache.clear()
+        self.assertNotEqual(request('/cached?name=a').read(), first)
+
+    def test_etag(self):
+        opener = urllib.request.build_opener(NoRedirection)
+        etag = request('/etag').headers['ETag']
+        req = urllib.request.Request('http://localhost:8080/etag',
+            headers={'If-None-Match': etag})
+        response = opener.open(req)
+        self.assertEqual((response.code, response.read()), (304, b''))
+        # validator checked before running the function
+        req = urllib.request.Request('http://localhost:8080/validated',
+            headers={'If-None-Match': '"v1"'})
+        self.assertEqual(opener.open(req).code, 304)
+        classes.validated.version = 2
+        response = opener.open(req)
+        self.assertEqual((response.code, response.headers['ETag']),
+            (200, '"v2"'))
+
+    def test_compression(self):
+        application.compression = Compression(min_size=0)
+        try:
+            headers = {'Accept-Encoding': 'br;q=1, gzip;q=0.5'}
+            for path in ['/', '/stream', '/scripts/functions.py']:
+                url = 'http://localhost:8080' + path
+                identity = urllib.request.urlopen(url).read()
+                response = urllib.request.urlopen(urllib.request.Request(url,
+                    headers=headers))
+                self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+                self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+                self.assertEqual(gzip.decompress(response.read()), identity)
+            # compressed static file is cached
+            self.assertEqual(len(application.compression.files), 1)
+            response = request('/events')
+            self.assertIsNone(response.headers['Content-Encoding'])
+        finally:
+            application.compression = None
+
+    def test_upload(self):
+        body = (b'--xyz\r\nContent-Disposition: form-data; name="name"\r\n'
+            b'\r\nbihan\r\n--xyz\r\nContent-Disposition: form-data; '
+            b'name="file"; filename="a.txt"\r\nContent-Type: text/plain\r\n'
+            b'\r\nline 1\r\nline 2\r\n--xyz--\r\n')
+        req = urllib.request.Request('http://localhost:8080/upload_fields',
+            body, {'Content-Type': 'multipart/form-data; boundary=xyz'})
+        res = json.loads(urllib.request.urlopen(req).read().decode('utf-8'))
+        self.assertEqual(res, {'name': 'bihan', 'filename': 'a.txt',
+            'content': 'line 1\r\nline 2'})
+        # malformed body
+        req = urllib.request.Request('http://localhost:8080/upload_fields',
+            body[:-10], {'Content-Type': 'multipart/form-data; boundary=xyz'})
+        with self.assertRaises(urllib.error.HTTPError) as cm:
+            urllib.request.urlopen(req)
+        self.assertEqual(cm.exception.code, 400)
+
+    def test_upload_stream(self):
+        body = (b'--xyz\r\nContent-Disposition: form-data; name="a"; '
+            b'filename="a.txt"\r\n\r\nabc\r\n--xyz\r\nContent-Disposition: '
+            b'form-data; name="b"\r\n\r\nvalue\r\n--xyz--\r\n')
+        req = urllib.request.Request('http://localhost:8080/upload_stream',
+            body, {'Content-Type': 'multipart/form-data; boundary=xyz'})
+        res = json.loads(urllib.request.urlopen(req).read().decode('utf-8'))
+        self.assertEqual(res, {
+            'a': ['a.txt', 'a9993e364706816aba3e25717850c26c9cd0d89d'],
+            'b': [None, 'f32b67c7e26342af42efabc674d441dca0a281c5']})
+
+class TestRouting(unittest.TestCase):
+
+    def test_literal_urls(self):
+        index = RouteIndex()
+        f = lambda dialog: None
+        index.add('/About/Us', f)
+        # case-insensitive lookup
+        self.assertEqual(index.match('/about/US'), (f, {}))
+        self.assertIsNone(index.match('/about'))
+
+    def test_smart_urls(self):
+        index = RouteIndex()
+        f, g = (lambda dialog: None), (lambda dialog: None)
+        index.add('/user/<id>', f)
+        # segment that mixes literal text and smart parts
+        index.add('/Page<n>-<m>.html', g)
+        self.assertEqual(index.match('/USER/12'), (f, {'id': '12'}))
+        self.assertEqual(index.match('/page1-2.HTML'),
+            (g, {'n': '1', 'm': '2'}))
+        self.assertIsNone(index.match('/page1-2.json'))
+        self.assertIsNone(index.match('/user/12/x'))
+        self.assertIsNone(index.match('/user'))
+
+    def test_overlaps(self):
+        index = RouteIndex()
+        index.add('/user/<id>', lambda dialog: None)
+        index.add('/<a>.html', lambda dialog: None)
+        self.assertEqual(index.overlaps('/user/new'), '/user/<id>')
+        self.assertEqual(index.overlaps('/<b>.html'), '/<a>.html')
+        self.assertEqual(index.overlaps('/page<b>'), '/<a>.html')
+        self.assertIsNone(index.overlaps('/<b>.json'))
+        self.assertIsNone(index.overlaps('/user/<id>/edit'))
+
+    def test_add_route(self):
+        def f(dialog): pass
+        def g(dialog): pass
+        routes, dispatch = {}, {}
+        application.add_route('get', '/user/<id>', f, routes, dispatch)
+        application.add_route('get', '/<a>.html', f, routes, dispatch)
+        application.add_route('get', '/<b>.json', g, routes, dispatch)
+        # other method
+        application.add_route('post', '/user/new', g, routes, dispatch)
+        with self.assertRaises(RoutingError):
+            application.add_route('get', '/user/new', g, routes, dispatch)
+        with self.assertRaises(RoutingError):
+            application.add_route('get', '/user/<name>', g, routes, dispatch)
+        self.assertEqual(dispatch['get'].match('/x.json'), (g, {'b': 'x'}))
+        self.assertEqual(dispatch['post'].match('/user/new'), (g, {}))
+
+    def test_load_routes(self):
+        module = types.ModuleType('routing_test')
+        exec('def index(dialog): pass\n'
+            'def item(dialog): pass\n'
+            'item.url = "item/<id>"\n'
+            'class page:\n'
+            '    url = "page/<name>.html"\n'
+            '    def get(self): pass\n', module.__dict__)
+        registered = application.registered
+        routes = getattr(application, 'routes', None)
+        dispatch = getattr(application, 'dispatch', None)
+        application.registered = [module]
+        try:
+            application.load_routes()
+            get = application.dispatch['get']
+            # function index is mapped to "/"
+            self.assertEqual(get.match('/'), (module.index, {}))
+            self.assertEqual(get.match('/index'), (module.index, {}))
+            self.assertEqual(get.match('/item/3'), (module.item, {'id': '3'}))
+            self.assertEqual(application.dispatch['post'].match('/item/3'),
+                (module.item, {'id': '3'}))
+            self.assertEqual(get.match('/Page/a.html'),
+                (module.page.get, {'name': 'a'}))
+            self.assertIsNone(application.dispatch.get('post', RouteIndex())
+                .match('/page/a.html'))
+            # ambiguous routes are detected when the routes are loaded
+            exec('def new(dialog): pass\n'
+                'new.url = "item/new"\n', module.__dict__)
+            with self.assertRaises(RoutingError):
+                application.load_routes()
+        finally:
+            application.registered = registered
+            application.routes, application.dispatch = routes, dispatch
+
+class TestRequest(unittest.TestCase):
+
+    def environ(self, body, ctype):
+        return {'REQUEST_METHOD': 'POST', 'PATH_INFO': '/', 'QUERY_STRING':
+            'x=1', 'CONTENT_TYPE': ctype, 'CONTENT_LENGTH': str(len(body)),
+            'HTTP_COOKIE': 'a=b', 'wsgi.input': io.BytesIO(body)}
+
+    def test_lazy_parsing(self):
+        environ = self.environ(b'{"y": [2]}', 'application/json')
+        req = Request(environ)
+        # nothing is parsed or read before it is used
+        self.assertIsNone(req._headers)
+        self.assertEqual(environ['wsgi.input'].tell(), 0)
+        self.assertEqual(req.cookies['a'].value, 'b')
+        self.assertEqual(req.fields, {'x': '1'})
+        self.assertEqual(environ['wsgi.input'].tell(), 0)
+        self.assertEqual(req.json(), {'y': [2]})
+        self.assertIs(req.json(), req.json())
+
+    def test_form_fields(self):
+        environ = self.environ(b'y=2&y=3',
+            'application/x-www-form-urlencoded')
+        req = Request(environ)
+        req.url_fields = {'z': '4'}
+        self.assertEqual(req.fields, {'x': '1', 'y': ['2', '3'], 'z': '4'})
+
+    def test_chunked_body(self):
+        body = b'{"x": 1}\n{"x": 2}\n\n{"x": 3}\n'
+        chunked = b''.join(b'%x;ext=1\r\n%s\r\n' % (len(body[i:i + 5]),
+            body[i:i + 5]) for i in range(0, len(body), 5)) + b'0\r\n\r\n'
+        environ = self.environ(chunked + b'next', 'application/x-ndjson')
+        del environ['CONTENT_LENGTH']
+        environ['HTTP_TRANSFER_ENCODING'] = 'chunked'
+        req = Request(environ)
+        self.assertEqual([value['x'] for value in req.ndjson()], [1, 2, 3])
+        # the data after the body is not read
+        self.assertEqual(environ['wsgi.input'].read(), b'next')
+
+    def test_stream(self):
+        environ = self.environ(b'line 1\nline 2\nnext', 'text/plain')
+        environ['CONTENT_LENGTH'] = '14'
+        req = Request(environ)
+        self.assertEqual(req.stream.readline(), b'line 1\n')
+        self.assertEqual(req.stream.read(3), b'lin')
+        self.assertEqual(req.stream.read(), b'e 2\n')
+        self.assertEqual(req.stream.read(), b'')
+
+    def test_own_attributes(self):
+        # attributes set by the script functions
+        req = Request(self.environ(b'', 'text/plain'))
+        req.user = 'bob'
+        self.assertEqual(req.user, 'bob')
+        self.assertIsNone(req._headers)
+
+class TestMultipart(unittest.TestCase):
+
+    def body(self, nb, content):
+        parts = [b'preamble']
+        for i in range(nb):
+            parts.append(b'--bound\r\nContent-Disposition: form-data; '
+                b'name="f[]"; filename="f%d"\r\n\r\n' % i + content)
+        return b'\r\n'.join(parts) + b'\r\n--bound--\r\n'
+
+    def test_parts(self):
+        content = bytes(range(256)) * 40 + b'\r\n--boun'
+        body = self.body(3, content)
+        # small blocks : boundaries are split between blocks
+        parser = MultipartParser(io.BytesIO(body), 'bound', len(body),
+            block_size=100, spool_size=1000)
+        parts = list(parser.parts())
+        self.assertEqual([part.filename for part in parts],
+            ['f0', 'f1', 'f2'])
+        for part in parts:
+            self.assertEqual(part.value, content)
+            # larger than spool_size : stored in a temporary file
+            self.assertNotIsInstance(part.file, io.BytesIO)
+
+    def test_stream(self):
+        body = self.body(2, b'abc')
+        parser = MultipartParser(io.BytesIO(body), 'bound')
+        parts = iter(parser)
+        self.assertEqual(next(parts).read(), b'abc')
+        # content not read : skipped
+        self.assertEqual(next(parts).name, 'f[]')
+        self.assertEqual(list(parts), [])
+
+    def test_stream_stopped(self):
+        body = (b'--bound\r\nContent-Disposition: form-data; name="file"; '
+            b'filename="f"\r\n\r\n' + b'x' * 200000 + b'\r\n--bound\r\n'
+            b'Content-Disposition: form-data; name="next"\r\n\r\nabc'
+            b'\r\n--bound--\r\n')
+        parser = MultipartParser(io.BytesIO(body), 'bound', len(body))
+        parts = iter(parser)
+        # the upload is rejected after its first chunk
+        for chunk in next(parts):
+            break
+        part = next(parts)
+        self.assertEqual((part.name, part.read()), ('next', b'abc'))
+        self.assertEqual(list(parts), [])
+
+    def test_limits(self):
+        body = self.body(3, b'abc')
+        with self.assertRaises(MultipartError):
+            list(MultipartParser(io.BytesIO(body), 'bound', max_parts=2))
+        with self.assertRaises(MultipartError):
+            list(MultipartParser(io.BytesIO(body), 'bound',
+                max_header_size=20))
+        with self.assertRaises(MultipartError):
+            list(MultipartParser(io.BytesIO(body[:-20]), 'bound'))
+
+class TestStaticIndex(unittest.TestCase):
+
+    @unittest.skipUnless(hasattr(os, 'symlink'), 'requires os.symlink')
+    def test_symlinks(self):
+        with tempfile.TemporaryDirectory() as directory:
+            os.makedirs(os.path.join(directory, 'assets', 'css'))
+            path = os.path.join(directory, 'assets', 'css', 'site.css')
+            open(path, 'w').close()
+            os.symlink(os.path.join(directory, 'assets'),
+                os.path.join(directory, 'static'))
+            # cycle
+            os.symlink(directory, os.path.join(directory, 'assets', 'up'))
+            index = StaticIndex(directory)
+            self.assertIn(path, index)
+            self.assertIn(os.path.join(directory, 'static', 'css',
+                'site.css'), index)
+
+    def test_refresh_without_index(self):
+        with self.assertRaises(RuntimeError):
+            application.refresh_static_index()
+
+class TestHeaders(unittest.TestCase):
+
+    def test_headers(self):
+        headers = Headers()
+        headers.set_type('text/html')
+        headers['Set-Cookie'] = 'a=1'
+        headers['set-cookie'] = 'b=2'
+        self.assertIn('SET-COOKIE', headers)
+        self.assertEqual(headers['content-type'], 'text/html')
+        self.assertEqual(headers.get_all('Set-Cookie'), ['a=1', 'b=2'])
+        self.assertIsNone(headers['Range'])
+        headers.replace_header('Content-Type', 'text/html; charset=utf-8')
+        headers.set_type('text/plain')
+        headers.set_param('boundary', 'xyz')
+        self.assertEqual(headers['Content-Type'],
+            'text/plain; charset=utf-8; boundary="xyz"')
+        del headers['Set-Cookie']
+        self.assertEqual(headers.items(), [('Content-Type',
+            'text/plain; charset=utf-8; boundary="xyz"')])
+        with self.assertRaises(KeyError):
+            headers.replace_header('Location', '/')
+
+try:
+    import patrom
+except ImportError:
+    patrom = None
+
+@unittest.skipIf(patrom is None, 'patrom is not installed')
+class TestTemplateCache(unittest.TestCase):
+
+    def test_template_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            page = os.path.join(directory, 'page.html')
+            with open(os.path.join(directory, 'title.html'), 'w') as out:
+                out.write('<h1><py expr="title"/></h1>')
+            with open(page, 'w') as out:
+                out.write('<py include="title.html"/>'
+                    '<py code="for item in items:"><b><py expr="item"/></b>'
+                    '</py>')
+            cache = TemplateCache(max_size=2)
+            # included templates are also compiled
+            self.assertEqual(cache.precompile([page]), 2)
+            # included templates are rendered with the current key/values
+            for title in ['a', 'b']:
+                result = cache.render(page, title=title, items=[1, 2])
+                self.assertEqual(''.join(result.split()),
+                    '<h1>{}</h1><b>1</b><b>2</b>'.format(title))
+            self.assertEqual(cache.misses, 0)
+            # modified file : compiled again
+            with open(page, 'w') as out:
+                out.write('<p><py expr="1 / 0"/></p>')
+            os.utime(page, ns=(0, 0))
+            with self.assertRaises(patrom.TemplateError):
+                cache.render(page)
+            self.assertEqual(cache.misses, 1)
+
+    def test_fragment_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            page = os.path.join(directory, 'page.html')
+            with open(os.path.join(directory, 'menu.html'), 'w') as out:
+                out.write('<b><py expr="role"/> <py expr="next(counter)"/></b>')
+            with open(page, 'w') as out:
+                out.write('<py include="menu.html" cache="60" keys="role"/>')
+            fragments = FragmentCache()
+            cache = TemplateCache(fragments=fragments)
+            counter = itertools.count()
+            render = lambda role: ''.join(cache.render(page, role=role,
+                counter=counter).split())
+            self.assertEqual(render('admin'), '<b>admin0</b>')
+            self.assertEqual(render('admin'), '<b>admin0</b>')
+            self.assertEqual(render('user'), '<b>user1</b>')
+            fragments.invalidate(os.path.join(directory, 'menu.html'),
+                role='admin')
+            self.assertEqual(render('admin'), '<b>admin2</b>')
+            self.assertEqual(render('user'), '<b>user1</b>')
+            # expired entry
+            key = fragments.key(os.path.join(directory, 'menu.html'),
+                ['role'], {'role': 'user'})
+            fragments.set(key, 'old', ttl=0)
+            self.assertEqual(render('user'), '<b>user3</b>')
+            # least recently used entries are removed
+            fragments.max_size = len('<b>user3</b>')
+            fragments.set(('x', ()), 'x')
+            self.assertIsNone(fragments.get(key))
+
+class TestCompression(unittest.TestCase):
+
+    def test_negotiate(self):
+        compression = Compression()
+        self.assertEqual(compression.negotiate('gzip, deflate, br'), 'gzip')
+        self.assertEqual(compression.negotiate('gzip;q=0, deflate'),
+            'deflate')
+        self.assertEqual(compression.negotiate('*'), 'gzip')
+        self.assertIsNone(compression.negotiate('br, identity'))
+        self.assertIsNone(compression.negotiate(None))
+        self.assertTrue(compression.compressible('text/html; charset=utf-8'))
+        self.assertTrue(compression.compressible('application/json'))
+        self.assertFalse(compression.compressible('text/event-stream'))
+        self.assertFalse(compression.compressible('image/png'))
+        data = b'bihan ' * 100
+        self.assertEqual(zlib.decompress(compression.compress(data,
+            'deflate')), data)
+
+class TestResponseCache(unittest.TestCase):
+
+    def test_stale_response(self):
+        cache = ResponseCache(max_size=10)
+        cache.set('key', CachedResponse('200 OK', [], b'body', 0.05))
+        self.assertIsNotNone(cache.get('key')[0])
+        time.sleep(0.05)
+        # expired : the first request regenerates the response, the others
+        # get the expired one
+        self.assertEqual(cache.get('key'), (None, True))
+        self.assertEqual(cache.get('key')[0].body, b'body')
+        cache.release('key')
+        self.assertEqual(cache.get('key'), (None, True))
+        time.sleep(0.05)
+        # too old to be sent
+        self.assertEqual(cache.get('key'), (None, False))
+        cache.set('other', CachedResponse('200 OK', [], b'x' * 8, 60))
+        self.assertEqual(list(cache.responses), ['other'])
+
+class TestThreadPool(unittest.TestCase):
+
+    def test_thread_pool(self):
+        application.load_routes()
+        httpd = server.make_server('localhost', 8081, application,
+            mode='threads', workers=2)
+        thread = threading.Thread(target=httpd.serve_forever, args=(0.05,))
+        thread.start()
+        try:
+            results = []
+            clients = [threading.Thread(target=lambda: results.append(
+                urllib.request.urlopen('http://localhost:8081/').read()))
+                for i in range(4)]
+            for client in clients:
+                client.start()
+            for client in clients:
+                client.join()
+            self.assertEqual(results, [b'hello'] * 4)
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+            thread.join()
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'requires os.fork')
+    def test_prefork_thread_pool(self):
+        application.load_routes()
+        httpd = server.make_server('localhost', 8085, application,
+            mode='threads', workers=2)
+        pid = os.fork()
+        if pid == 0:
+            try:
+                server.serve_prefork(httpd, 2, freeze_gc=False)
+            finally:
+                os._exit(0)
+        httpd.server_close()
+        try:
+            for i in range(4):
+                response = urllib.request.urlopen('http://localhost:8085/',
+                    timeout=5)
+                self.assertEqual(response.read(), b'hello')
+        finally:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+
+class TestKeepAlive(unittest.TestCase):
+
+    def test_keep_alive(self):
+        application.load_routes()
+        httpd = server.make_server('localhost', 8082, application,
+            keep_alive=True, keep_alive_timeout=1)
+        thread = threading.Thread(target=httpd.serve_forever, args=(0.05,))
+        thread.start()
+        try:
+            conn = http.client.HTTPConnection('localhost', 8082)
+            conn.request('GET', '/')
+            response = conn.getresponse()
+            self.assertEqual(response.read(), b'hello')
+            sock = conn.sock
+            # body of unknown length : chunked transfer encoding
+            conn.request('GET', '/stream')
+            response = conn.getresponse()
+            self.assertEqual(response.headers['Transfer-Encoding'], 'chunked')
+            self.assertEqual(response.read(), b'line 0\nline 1\nline 2\n')
+            # same connection
+            self.assertIs(conn.sock, sock)
+            conn.close()
+            # a request whose headers are not received in time
+            httpd.request_timeout = 0.2
+            sock = socket.create_connection(('localhost', 8082))
+            sock.settimeout(5)
+            sock.sendall(b'GET / HTTP/1.1\r\nHost: localhost\r\n')
+            self.assertEqual(sock.recv(1024), b'')
+            sock.close()
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+            thread.join()
+
+    def test_large_file(self):
+        application.load_routes()
+        httpd = server.make_server('localhost', 8082, application,
+            keep_alive=True)
+        thread = threading.Thread(target=httpd.serve_forever, args=(0.05,))
+        thread.start()
+        try:
+            self.assertEqual(read_large_file(8082), 2)
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+            thread.join()
+
+def read_large_file(port):
+    """Read a static file larger than the socket buffers twice on the same
+    connection, with a slow client. Return the number of complete reads."""
+    data = os.urandom(1 << 20) * 16
+    with tempfile.NamedTemporaryFile(dir=application.root,
+            suffix='.bin') as large:
+        large.write(data)
+        large.flush()
+        conn = http.client.HTTPConnection('localhost', port, timeout=10)
+        complete = 0
+        for i in range(2):
+            conn.request('GET', '/' + os.path.basename(large.name))
+            response = conn.getresponse()
+            # let the send buffer fill up
+            time.sleep(0.2)
+            complete += response.read() == data
+        conn.close()
+    return complete
+
+class TestEvented(unittest.TestCase):
+
+    def test_evented(self):
+        application.load_routes()
+        httpd = server.make_server('localhost', 8083, application,
+            server='evented', workers=2)
+        thread = threading.Thread(target=httpd.serve_forever, args=(0.05,))
+        thread.start()
+        try:
+            conn = http.client.HTTPConnection('localhost', 8083)
+            for i in range(3):
+                conn.request('GET', '/show_argument?x={}'.format(i))
+                res = json.loads(conn.getresponse().read().decode('utf-8'))
+                self.assertEqual(res, {'x': str(i)})
+            conn.request('POST', '/show_argument',
+                body=urllib.parse.urlencode({'x': 'post'}),
+                headers={'Content-Type': 'application/x-www-form-urlencoded'})
+            res = json.loads(conn.getresponse().read().decode('utf-8'))
+            self.assertEqual(res, {'x': 'post'})
+            conn.close()
+            # a body too large for the event loop, not received in time
+            httpd.request_timeout = 0.2
+            sock = socket.create_connection(('localhost', 8083))
+            sock.settimeout(5)
+            sock.sendall(b'POST /show_argument HTTP/1.1\r\n'
+                b'Host: localhost\r\nContent-Length: 100000\r\n'
+                b'Content-Type: application/x-www-form-urlencoded\r\n\r\n'
+                b'x=1')
+            while sock.recv(1024):
+                pass
+            sock.close()
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+            thread.join()
+
+    def test_large_file(self):
+        application.load_routes()
+        httpd = server.make_server('localhost', 8083, application,
+            server='evented', workers=2)
+        thread = threading.Thread(target=httpd.serve_forever, args=(0.05,))
+        thread.start()
+        try:
+            self.assertEqual(read_large_file(8083), 2)
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+            thread.join()
+
+    def test_shutdown_before_serve(self):
+        httpd = server.make_server('localhost', 8086, application,
+            server='evented')
+        httpd.shutdown()
+        httpd.server_close()
+
+class TestWebSocket(unittest.TestCase):
+
+    def test_websocket(self):
+        application.load_routes()
+        httpd = server.make_server('localhost', 8084, application,
+            mode='threads')
+        thread = threading.Thread(target=httpd.serve_forever, args=(0.05,))
+        thread.start()
+        try:
+            sock = socket.create_connection(('localhost', 8084))
+            sock.sendall(b'GET /echo HTTP/1.1\r\nHost: localhost\r\n'
+                b'Upgrade: websocket\r\nConnection: Upgrade\r\n'
+                b'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n'
+                b'Sec-WebSocket-Version: 13\r\n\r\n')
+            rfile = sock.makefile('rb')
+            self.assertIn(b' 101 ', rfile.readline())
+            headers = []
+            for line in iter(rfile.readline, b'\r\n'):
+                headers.append(line)
+            self.assertIn(b'Sec-WebSocket-Accept: '
+                b's3pPLMBiTxaQ9kYGzzhZRbK+xOo=\r\n', headers)
+            # masked text frame "hello"
+            mask = b'\x01\x02\x03\x04'
+            payload = bytes(c ^ mask[i % 4] for i, c in enumerate(b'hello'))
+            sock.sendall(b'\x81\x85' + mask + payload)
+            self.assertEqual(rfile.read(7), b'\x81\x05hello')
+            # close frame
+            sock.sendall(b'\x88\x80' + mask)
+            self.assertEqual(rfile.read(4), b'\x88\x02\x03\xe8')
+            rfile.close()
+            sock.close()
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+            thread.join()
+
+class TestASGI(unittest.TestCase):
+
+    def call(self, method, path, query=b'', body=b''):
+        messages = []
+        async def receive():
+            return {'type': 'http.request', 'body': body}
+        async def send(message):
+            messages.append(message)
+        scope = {'type': 'http', 'method': method, 'path': path,
+            'query_string': query, 'headers': [(b'host', b'localhost')]}
+        asyncio.run(ASGIApplication()(scope, receive, send))
+        self.assertEqual(messages[0]['type'], 'http.response.start')
+        return (messages[0]['status'],
+            b''.join(message['body'] for message in messages[1:]))
+
+    def test_async_function(self):
+        status, body = self.call('GET', '/async_hello', b'name=world')
+        self.assertEqual((status, body), (200, b'async world'))
+
+    def test_sync_function(self):
+        status, body = self.call('GET', '/show_argument', b'x=1')
+        self.assertEqual(json.loads(body.decode('utf-8')), {'x': '1'})
+        status, body = self.call('GET', '/stream')
+        self.assertEqual(body, b'line 0\nline 1\nline 2\n')
+
+    def test_static_file(self):
+        status, body = self.call('GET', '/scripts/classes.py')
+        with open(classes.__file__, 'rb') as f:
+            self.assertEqual(body, f.read())
+        status, body = self.call('GET', '/unknown')
+        self.assertEqual(status, 404)
+
+    def test_websocket(self):
+        for path, expected in [('/echo', 'hello'), ('/async_echo', 'HELLO')]:
+            received = [{'type': 'websocket.connect'},
+                {'type': 'websocket.receive', 'text': 'hello'},
+                {'type': 'websocket.disconnect', 'code': 1000}]
+            messages = []
+            async def receive():
+                return received.pop(0)
+            async def send(message):
+                messages.append(message)
+            scope = {'type': 'websocket', 'path': path, 'headers': []}
+            asyncio.run(ASGIApplication()(scope, receive, send))
+            self.assertEqual(messages, [{'type': 'websocket.accept'},
+                {'type': 'websocket.send', 'text': expected}])
+
 # start server in a thread
-from bihan import application
+from bihan import (application, server, Headers, Request, StaticCache,
+    StaticIndex, CachedResponse, Compression, FragmentCache, ResponseCache,
+    TemplateCache, RouteIndex, RoutingError)
+from bihan.asgi import ASGIApplication
+from bihan.multipart import MultipartParser, MultipartError
 from scripts import classes
 
 unittest.main()
\ No newline at end of file